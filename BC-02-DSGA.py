@@ -11,7 +11,6 @@ For the TCGA data, a gene threshold is not used when performing DSGA. The genes
 
 
 import hot_mapper as hm
-import pandas as pd
 
 
 #### SET UP EXPERIMENT
@@ -20,10 +19,11 @@ output_path = f"{project_directory}/output/processed_data"
 
 
 #### READ IN FILES
-metabric_t = pd.read_csv(filepath_or_buffer = F"{output_path}/metabric_tumour_matched.csv", sep = ",", index_col = 0)
-metabric_n = pd.read_csv(filepath_or_buffer = F"{output_path}/metabric_normal_matched.csv", sep = ",", index_col = 0)
-tcga_t = pd.read_csv(filepath_or_buffer = F"{output_path}/tcga_tumour_matched.csv", sep = ",", index_col = 0)
-tcga_n = pd.read_csv(filepath_or_buffer = F"{output_path}/tcga_normal_matched.csv", sep = ",", index_col = 0)
+# the matched matrices are saved by step 1 in .npy format
+metabric_t = hm.data_cache.load_matrix(F"{output_path}/metabric_tumour_matched.npy")
+metabric_n = hm.data_cache.load_matrix(F"{output_path}/metabric_normal_matched.npy")
+tcga_t = hm.data_cache.load_matrix(F"{output_path}/tcga_tumour_matched.npy")
+tcga_n = hm.data_cache.load_matrix(F"{output_path}/tcga_normal_matched.npy")
 
 
 #### RUN DSGA
@@ -42,5 +42,5 @@ print(f"TCGA genes matched to METABRIC genes: {tcga_dct_thres.shape}")
 
 
 #### SAVE OUTPUT
-metabric_dct.to_csv(F"{output_path}/metabric_dct.csv") 
-tcga_dct_thres.to_csv(F"{output_path}/tcga_dct.csv") 
+hm.data_cache.write_matrix(metabric_dct, F"{output_path}/metabric_dct.csv") 
+hm.data_cache.write_matrix(tcga_dct_thres, F"{output_path}/tcga_dct.csv") 
@@ -18,7 +18,7 @@ import hot_mapper as hm
 import numpy as np
 import pandas as pd
 import hdbscan
-from lifelines.statistics import logrank_test
+from pathlib import Path
 
 
 
@@ -29,7 +29,7 @@ dataset_name = "tcga"
 discovery_dataset = "metabric"
 
 #### READ IN FILES
-X = pd.read_csv(f"{project_directory}/output/processed_data/{dataset_name}_dct.csv", index_col = 0)
+X = hm.data_cache.read_matrix(f"{project_directory}/output/processed_data/{dataset_name}_dct.csv")
 survival_df = pd.read_csv(f"{project_directory}/output/processed_data/{dataset_name}_survival.csv", index_col = 0)
 
 
@@ -43,11 +43,18 @@ os = np.array((survival_df['time']<=120) & (survival_df['event'] == 1)).astype(i
 
 #### BUILD LENS FUNCTION IDENTIFIED ON DISCOVERY DATASET
 parameters_file_path = f"{project_directory}/output/hotspot_search/discovery_final_results" 
-weights = np.genfromtxt(f"{parameters_file_path}/{discovery_dataset}_weights.txt")
-feature_list = np.genfromtxt(f"{parameters_file_path}/{discovery_dataset}_feature_list.txt", dtype = "i4")
+lens_id_file = Path(f"{parameters_file_path}/{discovery_dataset}_lens_id.txt")
 
 #build the predefined lens from the discovery search on the validation data
-discovery_lens = hm.random_lens.Lens(np.array(X), nonzero_features = len(weights), weights = weights, feature_list = feature_list) 
+#a new discovery search saves a lens id, the paper results save the weights and feature list
+if lens_id_file.exists():
+    discovery_lens = hm.random_lens.lens_from_id(np.array(X), lens_id_file.read_text().strip())
+    weights = discovery_lens["weights"]
+    feature_list = discovery_lens["feature_list"]
+else:
+    weights = np.genfromtxt(f"{parameters_file_path}/{discovery_dataset}_weights.txt")
+    feature_list = np.genfromtxt(f"{parameters_file_path}/{discovery_dataset}_feature_list.txt", dtype = "i4")
+    discovery_lens = hm.random_lens.Lens(np.array(X), nonzero_features = len(weights), weights = weights, feature_list = feature_list) 
 
 
 
@@ -85,28 +92,16 @@ columns = ["interval", "overlap", "nodes", "size", "logrank"]
 
 #multiple graphs are generated from the different successful parameter options 
 #the hotspots in each graph are tested for significant survival 
-for ps, collection in search.parameter_samples.items():
-    for i, hotspot_samples in enumerate(collection):
-        hotspot_results = []
-        #seperate the er+ cohort into hotspot and global neighbourhood
-        y = pd.DataFrame([0] * len(X.index), columns = ["hotspot"], index = X.index)
-        X_H = X.iloc[hotspot_samples]
-        y.loc[X_H.index,"hotspot"] = 1
-
-        #apply log rank test to each hotspot division 
-        hot = (y["hotspot"] == 1)
-        T = survival_df["time"]
-        E = survival_df["event"]
-
-        lr = logrank_test(T[hot], T[~hot], event_observed_A=E[hot], event_observed_B=E[~hot], alpha=99)
-        pvalue = lr.p_value
-        
-        
-        #if any hotspots have lower p-value than 0.001 then results are saved 
-        #append results to list to build dataframe summarising survival analysis for each hotspot 
-        hotspot_id.append(str(ps[0]) + str(int(ps[1] * 100)) + str(i))
-        hotspot_results = [ps[0], ps[1], p_success[ps][i], sum(y["hotspot"]), pvalue]
-        survival_results.append(hotspot_results)
+#against the global neighbourhood, with the log rank test of all hotspots computed at once
+scorer = hm.survival.LogRankScorer(survival_df.loc[X.index, "time"], survival_df.loc[X.index, "event"])
+hotspot_keys = [(ps, i) for ps, collection in search.parameter_samples.items() for i in range(len(collection))]
+logrank = scorer.score([search.parameter_samples[ps][i] for ps, i in hotspot_keys])
+
+for (ps, i), size, pvalue in zip(hotspot_keys, logrank["size"], logrank["p_value"]):
+    #append results to list to build dataframe summarising survival analysis for each hotspot 
+    hotspot_id.append(str(ps[0]) + str(int(ps[1] * 100)) + str(i))
+    hotspot_results = [ps[0], ps[1], p_success[ps][i], int(size), pvalue]
+    survival_results.append(hotspot_results)
 
 
 #if any hotspots have lower p-value than 0.001 then search ends
@@ -123,6 +118,8 @@ hotspot_df.to_csv(f"{output_path}/{dataset_name}_hotspot_dataframe.csv")
 np.savetxt(f"{output_path}/{dataset_name}_parameters.txt", top_parameters)
 np.savetxt(f"{output_path}/{dataset_name}_weights.txt", weights ,delimiter=",")
 np.savetxt(f"{output_path}/{dataset_name}_feature_list.txt", feature_list ,delimiter=",")
+if "lens_id" in discovery_lens:
+    np.savetxt(f"{output_path}/{dataset_name}_lens_id.txt", [discovery_lens["lens_id"]], fmt = "%s")
 
 
 
@@ -27,6 +27,7 @@ import hot_mapper as hm
 from hdbscan import HDBSCAN
 
 from itertools import chain
+from pathlib import Path
 from sklearn.metrics import pairwise_distances
 
 
@@ -38,7 +39,7 @@ dataset_name = "tcga"
 
 
 #### READ IN FILES
-X = pd.read_csv(f"{project_directory}/output/processed_data/{dataset_name}_dct.csv", index_col = 0)
+X = hm.data_cache.read_matrix(f"{project_directory}/output/processed_data/{dataset_name}_dct.csv")
 survival_df = pd.read_csv(f"{project_directory}/output/processed_data/{dataset_name}_survival.csv", index_col = 0)
 
 
@@ -67,9 +68,12 @@ overlap = parameters[1]
 print(f"Number of intervals: {intervals}, \nOverlap percentage: {overlap * 100}%")
 
 # Use feature weights and feature selection from successful lens 
-# These two variable will be used as input to the Lens class
-weights = np.genfromtxt(f"{parameters_file_path}/{dataset_name}_weights.txt")
-feature_list = np.genfromtxt(f"{parameters_file_path}/{dataset_name}_feature_list.txt", dtype = "i4")
+# A new search saves a lens id, which regenerates the lens. Otherwise (as for the paper results)
+# the weights and feature list are read from file and used as input to the Lens class
+lens_id_file = Path(f"{parameters_file_path}/{dataset_name}_lens_id.txt")
+if not lens_id_file.exists():
+    weights = np.genfromtxt(f"{parameters_file_path}/{dataset_name}_weights.txt")
+    feature_list = np.genfromtxt(f"{parameters_file_path}/{dataset_name}_feature_list.txt", dtype = "i4")
 
 # Specify number of nonzero features in lens
 feature_no = int(X.shape[1]/2)
@@ -80,10 +84,14 @@ feature_no = int(X.shape[1]/2)
 
 #### BUILD MAPPER
 # Generate the successful lens function
-linear_lens = hm.random_lens.Lens(np.array(X), 
-                                  nonzero_features = feature_no, 
-                                  weights = weights, 
-                                  feature_list = feature_list)
+if lens_id_file.exists():
+    linear_lens = hm.random_lens.lens_from_id(np.array(X), lens_id_file.read_text().strip())
+    feature_list = linear_lens["feature_list"]
+else:
+    linear_lens = hm.random_lens.Lens(np.array(X), 
+                                      nonzero_features = feature_no, 
+                                      weights = weights, 
+                                      feature_list = feature_list)
 
 
 # Specify the parameters for the Mapper graph
@@ -160,7 +168,7 @@ survival_df.to_csv(f"{project_directory}/output/processed_data/{dataset_name}_ho
 # ### COMPARE DISTANCE TO METABRIC CENTROIDS
 
 # read in metabric samples
-X_meta = pd.read_csv(f"{project_directory}/output/processed_data/metabric_dct.csv", index_col = 0)
+X_meta = hm.data_cache.read_matrix(f"{project_directory}/output/processed_data/metabric_dct.csv")
 metabric_hotspot_samples = pd.read_csv(f"{project_directory}/output/processed_data/metabric_hotspot_id_survival.csv", 
                               index_col = 0)
 
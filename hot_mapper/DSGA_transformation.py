@@ -9,48 +9,224 @@ Diseased tissue data is transformed into two components - the normal component a
 
 """
 
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
 from sklearn.decomposition import PCA
 import scipy.signal as ss
-from scipy.stats.stats import pearsonr
 import pandas as pd
 
 
 
 
-def flat_construction(df_N):
-    """Perform FLAT construction by constructing a linear model fit of the normal tumour vector genes as rows and samples as columns"""
+def _flat_lstsq_chunk(normal_T, normal_FLAT, start, stop):
+    """Fit columns start to stop-1 of normal_T on the remaining columns, writing each fit into normal_FLAT"""
+
+    n, p = normal_T.shape
 
-    df_normal = df_N.to_numpy()
-    normal_T = df_normal.transpose()
-    normal_FLAT = np.empty(normal_T.shape)
+    #the remaining columns are held in one reusable matrix, so removing a column only needs the previous one copied back in
+    normal_i = np.empty((n, p - 1))
+    normal_i[:,:start] = normal_T[:,:start]
+    normal_i[:,start:] = normal_T[:,start+1:]
 
-    #for each gene in the normal vector
-    for i in range(0,normal_T.shape[1]):
+    #for each gene in the chunk
+    for i in range(start, stop):
+        if i > start:
+            normal_i[:,i-1] = normal_T[:,i-1] #restore the previous gene
         n_i = normal_T[:,i] #take each gene seperately
-        normal_i = np.delete(normal_T, i, 1) #remove it from the dataframe
         x = np.linalg.lstsq(normal_i, n_i, rcond=None) #construct linear model
         b = normal_i@x[0] #find fit of model
         normal_FLAT[:,i] = b #this is the new normal vector value
 
+
+def _flat_lstsq_memmap_chunk(normal_path, flat_path, shape, start, stop):
+    """Process pool worker, reading the normal matrix and writing the fits through shared memmaps"""
+
+    normal_T = np.memmap(normal_path, dtype=float, mode="r", shape=shape)
+    normal_FLAT = np.memmap(flat_path, dtype=float, mode="r+", shape=shape)
+    _flat_lstsq_chunk(normal_T, normal_FLAT, start, stop)
+    normal_FLAT.flush()
+
+
+def _flat_construction_lstsq(normal_T, n_jobs = 1, max_memory = None, backend = "process"):
+    """FLAT construction solving one least squares problem per column, with the columns split into chunks across workers.
+
+    Each worker holds a copy of the normal matrix with one column removed plus the lstsq workspace, so
+    the number of workers is reduced until this temporary allocation fits within max_memory bytes.
+    At least one worker is always used."""
+
+    n, p = normal_T.shape
+    normal_T = np.ascontiguousarray(normal_T, dtype=float)
+
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if max_memory is not None:
+        worker_memory = 2 * normal_T.nbytes
+        n_jobs = min(n_jobs, max(1, int(max_memory // worker_memory)))
+    n_jobs = max(1, min(n_jobs, p))
+
+    if n_jobs == 1:
+        normal_FLAT = np.empty(normal_T.shape)
+        _flat_lstsq_chunk(normal_T, normal_FLAT, 0, p)
+        return normal_FLAT
+
+    #several chunks per worker to even out the solve times between workers
+    bounds = np.linspace(0, p, min(p, 4 * n_jobs) + 1).astype(int)
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+
+    if backend == "thread":
+        normal_FLAT = np.empty(normal_T.shape)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_flat_lstsq_chunk, normal_T, normal_FLAT, start, stop) for start, stop in chunks]
+            for f in futures:
+                f.result()
+        return normal_FLAT
+
+    #processes share the normal matrix and the output through memmaps rather than pickling them
+    with tempfile.TemporaryDirectory() as tmp:
+        normal_path = os.path.join(tmp, "normal.dat")
+        flat_path = os.path.join(tmp, "flat.dat")
+        normal_mm = np.memmap(normal_path, dtype=float, mode="w+", shape=normal_T.shape)
+        normal_mm[:] = normal_T
+        normal_mm.flush()
+        flat_mm = np.memmap(flat_path, dtype=float, mode="w+", shape=normal_T.shape)
+        flat_mm.flush()
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_flat_lstsq_memmap_chunk, normal_path, flat_path, normal_T.shape, start, stop) for start, stop in chunks]
+            for f in futures:
+                f.result()
+
+        normal_FLAT = np.array(flat_mm)
+        del normal_mm, flat_mm
+
     return normal_FLAT
 
 
-def wold_invariant(normal_FLAT):
-    """Compute and plot the Wold invariant of PCA. Identify the number of principal components for the healthy state model"""
+def _flat_construction_svd(normal_T):
+    """Closed-form FLAT construction, obtaining every leave-one-out fit from a single SVD.
+
+    With normal_T = U S V^T, the fit of column i on the remaining columns is the column itself unless
+    removing it lowers the rank of the matrix. This happens when the leverage h_i = ||v_i||^2 of
+    the column is one, and the fit then loses the component along U S^-1 v_i. The rank decision uses
+    the same singular value cut-off as np.linalg.lstsq on the reduced matrix."""
+
+    n, p = normal_T.shape
+    U, S, Vt = np.linalg.svd(normal_T, full_matrices=False)
+
+    #discard singular values that lstsq would treat as zero
+    eps = np.finfo(normal_T.dtype).eps
+    rank = np.sum(S > eps * max(n, p) * S[0]) if S.size else 0
+    U, S, Vt = U[:,:rank], S[:rank], Vt[:rank]
+
+    #leverage of each column and the direction removed along with it
+    leverage = np.sum(np.square(Vt), axis=0)
+    W = Vt / S[:,None]
+    w_norm_sqr = np.sum(np.square(W), axis=0)
+
+    #the smallest singular value of the reduced matrix is sqrt(1 - h_i) / ||S^-1 v_i||
+    #1 - h_i can only be resolved to the rounding error of the leverage sum
+    cutoff = eps * max(n, p - 1) * S[0] if rank else 0
+    drops_rank = (1 - leverage) <= np.maximum(np.square(cutoff) * w_norm_sqr, eps * max(n, p))
+
+    normal_FLAT = U @ (S[:,None] * Vt)
+    if np.any(drops_rank):
+        normal_FLAT[:,drops_rank] -= U @ (W[:,drops_rank] / w_norm_sqr[drops_rank])
+
+    return normal_FLAT
+
+
+def flat_construction(df_N, method = "svd", n_jobs = 1, max_memory = None, backend = "process"):
+    """Perform FLAT construction by constructing a linear model fit of the normal tumour vector genes as rows and samples as columns
+
+    Parameters
+    ----------
+
+    method : ["svd"],["lstsq"], default: ``"svd"``
+        Selects the closed-form leave-one-out fit from a single SVD ("svd") or one least squares solve per column ("lstsq")
+
+    n_jobs : int, default: ``1``
+        Number of worker processes the "lstsq" columns are split across, -1 uses all cores. The "svd" method runs in a single call
+
+    max_memory : int, default: ``None``
+        Upper bound in bytes on the temporary matrices held by the "lstsq" workers
+
+    backend : ["process"],["thread"], default: ``"process"``
+        Pool used for the "lstsq" workers. Processes share the normal matrix through a memmap
+        """
 
-    features_no = normal_FLAT.shape[1] #number of samples
-    pca = PCA(n_components=features_no)
+    normal_T = df_N.to_numpy(dtype=float).transpose()
+
+    flat_methods = {"svd": _flat_construction_svd,
+                    "lstsq": partial(_flat_construction_lstsq, n_jobs = n_jobs, max_memory = max_memory, backend = backend)}
+
+    return flat_methods[method](normal_T)
+
+
+def check_flat_construction(df_N, rtol = 1e-6, atol = 1e-8):
+    """Check the closed-form FLAT construction is numerically equivalent to the per column least squares loop"""
+
+    normal_T = df_N.to_numpy(dtype=float).transpose()
+    flat_svd = _flat_construction_svd(normal_T)
+    flat_lstsq = _flat_construction_lstsq(normal_T)
+
+    max_difference = np.max(np.abs(flat_svd - flat_lstsq))
+    print(F"maximum absolute difference between FLAT methods: {max_difference}")
+
+    return np.allclose(flat_svd, flat_lstsq, rtol=rtol, atol=atol)
+
+
+def _wold_statistic(sin_val_sqr, remainder, n, R):
+    """Wold invariant for each principal component, taking the tail sums of the squared singular values from a cumulative sum.
+    remainder is the squared singular value mass of any components beyond those computed"""
+
+    #tail[l] is the sum of the squared singular values after component l
+    tail = np.append(np.cumsum(sin_val_sqr[::-1])[::-1][1:], 0) + remainder
+
+    l = np.arange(len(sin_val_sqr))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wold = (sin_val_sqr/tail)*(((n-l-1)*(R-l))/(n+R-2*l))
+
+    return wold
+
+
+def wold_invariant(normal_FLAT, svd_solver = "full", max_components = None, random_state = None):
+    """Compute and plot the Wold invariant of PCA. Identify the number of principal components for the healthy state model
+
+    Parameters
+    ----------
+
+    svd_solver : ["full"],["randomized"],["arpack"], default: ``"full"``
+        SVD solver used by the PCA. "randomized" and "arpack" only compute the leading components
+
+    max_components : int, default: ``None``
+        Ceiling on the number of principal components computed, all components are computed if None
+
+    random_state : int, default: ``None``
+        Seed for the randomized SVD solver
+        """
+
+    R = normal_FLAT.shape[1] #number of samples
+    n = normal_FLAT.shape[0]
+
+    features_no = R if max_components is None else min(max_components, R)
+    pca = PCA(n_components=features_no, svd_solver=svd_solver, random_state=random_state)
     principalComponents = pca.fit_transform(normal_FLAT)
 
     sin_val = pca.singular_values_ #singular values
     sin_val_sqr = np.square(sin_val) #squared singular values
 
-    R = normal_FLAT.shape[1]
-    n = normal_FLAT.shape[0]
+    #the components that were not computed still contribute to the tail of the Wold invariant
+    remainder = 0
+    if len(sin_val_sqr) < R:
+        total_sqr = n * np.sum(np.var(normal_FLAT, axis=0))
+        remainder = max(total_sqr - np.sum(sin_val_sqr), 0)
 
-    #calculate list holding Wold invariant values
-    wold = [(sin_val_sqr[l]/(np.sum(sin_val_sqr[l+1:])))*(((n-l-1)*(R-l))/(n+R-2*l)) for l in range(0,R)]
+    #calculate array holding Wold invariant values
+    wold = _wold_statistic(sin_val_sqr, remainder, n, R)
 
     #find the most prominent peak in Wold value
     peaks, _ = ss.find_peaks(wold)
@@ -63,24 +239,56 @@ def wold_invariant(normal_FLAT):
     return (principalComponents, spike_index)
 
 
+def _HSM_basis(principalComponents, spike_index):
+    """Orthonormal basis of the healthy state model from the Wold principal components"""
+
+    HSM = principalComponents[:,:int(np.ravel(spike_index)[0])]
+
+    #the principal components are orthogonal, so the fit of the tumour vector to the
+    #healthy state model is a projection onto the normalised components
+    component_norms = np.linalg.norm(HSM, axis=0)
+    return HSM[:,component_norms > 0] / component_norms[component_norms > 0]
+
+
 def HSM(df_T, principalComponents, spike_index):
     """Choose the number of Wold components to build the Healthy State Model"""
 
     df_tumour = df_T.to_numpy()
     tumour_T = df_tumour.transpose()
-    HSM = principalComponents[:,:int(spike_index)]
+    HSM_basis = _HSM_basis(principalComponents, spike_index)
 
-    #fit tumour vector to healthy state model
-    x = np.linalg.lstsq(HSM, tumour_T, rcond=None)
-
-    NcT = HSM@x[0] #healthy component
+    NcT = HSM_basis@(HSM_basis.T@tumour_T) #healthy component
     DcT = tumour_T - NcT #diseased component
 
     return DcT
 
 
-def threshold_coord(DcT):
-    """Threshold data coordinates (genes, proteins, etc.) so that only the genes that show a significant deviation from the healthy state are retained """
+def _standardise_rows(mat):
+    """Centre each row and scale it to unit length, so that row dot products are Pearson correlations"""
+
+    centred = mat - mat.mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return centred / np.linalg.norm(centred, axis=1, keepdims=True)
+
+
+def threshold_coord(DcT, relaxed_quantile = 0.85, stringent_quantile = 0.98, correlation_cutoff = 0.6, min_correlated = 1):
+    """Threshold data coordinates (genes, proteins, etc.) so that only the genes that show a significant deviation from the healthy state are retained
+
+    Parameters
+    ----------
+
+    relaxed_quantile : float, default: ``0.85``
+        Quantile of the gene deviations a gene must pass to be considered for retention
+
+    stringent_quantile : float, default: ``0.98``
+        Quantile of the gene deviations defining the stringent genes
+
+    correlation_cutoff : float, default: ``0.6``
+        Pearson correlation a relaxed gene must exceed with a stringent gene to count as correlated
+
+    min_correlated : int, default: ``1``
+        Number of correlated stringent genes needed to retain a relaxed gene
+        """
 
     #find the 5th and 95th quantile of each gene 
     #take the absolute value
@@ -89,59 +297,214 @@ def threshold_coord(DcT):
 
     q_abs = q_df[["Q5", "Q95"]].max(axis=1)
 
-    #list of genes that pass the 85th and 98th percentile
-    q85 = q_abs.quantile(q=0.85) #relaxed
-    q98 = q_abs.quantile(q=0.98) #stringent
+    #list of genes that pass the relaxed and stringent percentiles
+    q_relaxed = q_abs.quantile(q=relaxed_quantile)
+    q_stringent = q_abs.quantile(q=stringent_quantile)
 
-    relaxed = DcT[q_abs > q85]
-    stringent = DcT[q_abs > q98]
+    relaxed = DcT[q_abs > q_relaxed]
+    stringent = DcT[q_abs > q_stringent]
 
+    #correlation between every relaxed and stringent gene from one matrix product
+    relaxed_std = _standardise_rows(relaxed.to_numpy(dtype=float))
+    stringent_std = _standardise_rows(stringent.to_numpy(dtype=float))
+    correlation_QR = relaxed_std @ stringent_std.T
 
-    #empty dataframe of patients
-    Dc_mat = pd.DataFrame(columns = DcT.columns)
+    #retain the relaxed genes correlated with enough stringent genes
+    with np.errstate(invalid="ignore"):
+        sig_sum = np.sum(correlation_QR > correlation_cutoff, axis=1)
+    Dc_mat = relaxed[sig_sum >= min_correlated]
 
-    #if the gene passess the 85th threshold
-    for i in range(0 , len(relaxed)):
-        correlation_QR = []
-        gene_r = relaxed.iloc[i,:]
+    #return matrix so patients are rows and genes are columns
+    Dc_mat_T = Dc_mat.T
+    return Dc_mat_T
 
-        #find the correlation between that gene and the stringent genes
-        for j in range(0 , len(stringent)):
-            gene_s = stringent.iloc[j,:]
 
-            corr, _ = pearsonr(gene_r, gene_s)
-            correlation_QR.append(corr)
+def _read_sample_blocks(source, genes, block_size):
+    """Yield a tumour dataset (samples as rows, genes as columns) in blocks of samples.
+    source may be a dataframe, a .csv or .parquet file path, or an array or memmap with genes in model order"""
 
-        #if r>0.6 with over 3 stringent genes
-        sig_sum = sum(val > 0.6 for val in correlation_QR)
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, source.shape[0], block_size):
+            yield source.iloc[start:start+block_size]
 
-        #retain that gene
-        if sig_sum > 0.6:
-            Dc_mat = Dc_mat.append(gene_r)
+    elif isinstance(source, np.ndarray):
+        for start in range(0, source.shape[0], block_size):
+            yield pd.DataFrame(np.asarray(source[start:start+block_size]),
+                               index=np.arange(start, min(start+block_size, source.shape[0])),
+                               columns=genes)
 
-    #return matrix so patients are rows and genes are columns
-    Dc_mat_T = Dc_mat.T
-    return Dc_mat_T
+    elif str(source).endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=block_size):
+            yield batch.to_pandas()
 
+    else:
+        for block in pd.read_csv(source, sep = ",", index_col = 0, chunksize = block_size):
+            yield block
 
-def DSGA(df_normal, df_tumour, threshold = True):
-    """Perform disease-specific genomic analysis on a tumour dataset, referencing against a healthy tissue dataset"""
 
-    print(str(df_tumour.shape[1]) + " co-ordinates as input")
-    #obtain flat construction of normal genes
-    df_normal_flat = flat_construction(df_normal)
+class HealthyStateModel():
+    """ The HealthyStateModel class holds a healthy state model fitted on normal tissue data, so that
+    new tumour cohorts can be transformed without repeating the FLAT construction and PCA. The workflow allows you to:
+            1. Fit the model on a normal tissue dataset (samples as rows, genes as columns)
+            2. Save the model to a .npz file and load it again later
+            3. Transform tumour datasets with the same genes into their disease component
+            4. Stream cohorts larger than memory through the model in blocks of samples
+
+    Parameters
+    ----------
+
+    flat_method, n_jobs, max_memory, backend : passed to flat_construction. n_jobs, max_memory and backend only apply
+    with flat_method = "lstsq"
+
+    svd_solver, max_components, random_state : passed to wold_invariant
+            """
+
+
+    def __init__(self, flat_method = "svd", n_jobs = 1, max_memory = None, backend = "process", svd_solver = "full", max_components = None, random_state = None):
+
+        self.flat_method = flat_method
+        self.n_jobs = n_jobs
+        self.max_memory = max_memory
+        self.backend = backend
+        self.svd_solver = svd_solver
+        self.max_components = max_components
+        self.random_state = random_state
+
+
+
+    def fit(self, df_normal):
+        """Build the healthy state model from the Wold principal components of the FLAT normal data"""
+
+        #obtain flat construction of normal genes
+        df_normal_flat = flat_construction(df_normal, method = self.flat_method, n_jobs = self.n_jobs, max_memory = self.max_memory, backend = self.backend)
+
+        #calculate the number Wold principal components
+        #and the value at which they spike
+        principalComponents, spike_index = wold_invariant(df_normal_flat,
+                                                          svd_solver = self.svd_solver,
+                                                          max_components = self.max_components,
+                                                          random_state = self.random_state)
+
+        self.basis = _HSM_basis(principalComponents, spike_index)
+        self.spike_index = int(np.ravel(spike_index)[0])
+        self.genes = df_normal.columns.to_numpy(dtype=str)
+
+        return self
+
+
+
+    def _tumour_matrix(self, df_tumour):
+        """Return the tumour data as genes by samples, in the gene order of the model"""
+
+        gene_positions = pd.Index(df_tumour.columns.astype(str)).get_indexer(self.genes)
+        if np.any(gene_positions < 0):
+            raise KeyError(F"{np.sum(gene_positions < 0)} genes in the healthy state model are missing from the tumour data")
+
+        return df_tumour.to_numpy(dtype=float)[:,gene_positions].transpose(), df_tumour.columns[gene_positions]
+
 
-    #calculate the number Wold principal components
-    #and the value at which they spike
-    principalComponents, spike_index = wold_invariant(df_normal_flat)
 
-    #construct a healthy state model using the tumour data
-    DcT = HSM(df_tumour, principalComponents, spike_index)
+    def transform(self, df_tumour):
+        """Return the disease component (DcT) of a tumour dataset as a dataframe with genes as rows and samples as columns"""
 
-    #convert DcT to a pandas dataframe with the genes and columns kept
-    DcT_df =  pd.DataFrame(data=DcT,
-                           index=df_tumour.columns,
-                           columns=df_tumour.index)
+        tumour_T, genes = self._tumour_matrix(df_tumour)
+
+        NcT = self.basis@(self.basis.T@tumour_T) #healthy component
+        DcT = tumour_T - NcT #diseased component
+
+        return pd.DataFrame(data=DcT, index=genes, columns=df_tumour.index)
+
+
+
+    def iter_transform(self, source, block_size = 1000):
+        """Yield the disease component of a tumour dataset in blocks of samples, with samples as rows and genes as columns.
+        Only one block of the tumour data is held in memory at a time"""
+
+        for block in _read_sample_blocks(source, self.genes, block_size):
+            yield self.transform(block).transpose()
+
+
+
+    def transform_to_file(self, source, file_name, block_size = 1000):
+        """Stream the disease component of a tumour dataset to a .csv or .parquet file, block by block.
+        Returns the number of samples written"""
+
+        parquet = str(file_name).endswith(".parquet")
+        if parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+        n_samples = 0
+        writer = None
+        try:
+            for DcT_block in self.iter_transform(source, block_size = block_size):
+                if parquet:
+                    table = pa.Table.from_pandas(DcT_block)
+                    if writer is None:
+                        writer = pq.ParquetWriter(file_name, table.schema)
+                    writer.write_table(table)
+                else:
+                    DcT_block.to_csv(file_name, mode = "w" if n_samples == 0 else "a", header = n_samples == 0)
+                n_samples += DcT_block.shape[0]
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return n_samples
+
+
+
+    def save(self, file_name):
+        """Save the fitted healthy state model to a compressed .npz file. The .npz extension is added to the
+        file name when missing, as by numpy"""
+
+        np.savez_compressed(_npz_file_name(file_name),
+                            basis = self.basis,
+                            spike_index = self.spike_index,
+                            genes = self.genes)
+
+
+
+    @classmethod
+    def load(cls, file_name):
+        """Load a healthy state model saved with save, from the same file name given to save"""
+
+        with np.load(_npz_file_name(file_name), allow_pickle=False) as f:
+            model = cls()
+            model.basis = f["basis"]
+            model.spike_index = int(f["spike_index"])
+            model.genes = f["genes"]
+
+        return model
+
+
+
+def _npz_file_name(file_name):
+    """File name with the .npz extension that numpy adds on saving"""
+
+    file_name = str(file_name)
+    return file_name if file_name.endswith(".npz") else file_name + ".npz"
+
+
+def DSGA(df_normal, df_tumour, threshold = True, flat_method = "svd", n_jobs = 1, max_memory = None, backend = "process", svd_solver = "full", max_components = None):
+    """Perform disease-specific genomic analysis on a tumour dataset, referencing against a healthy tissue dataset.
+
+    flat_method, n_jobs, max_memory and backend are passed to flat_construction. The default "svd" FLAT construction
+    is a single call, so n_jobs, max_memory and backend only apply with flat_method = "lstsq"
+    """
+
+    print(str(df_tumour.shape[1]) + " co-ordinates as input")
+    #build the healthy state model from the normal data
+    model = HealthyStateModel(flat_method = flat_method,
+                              n_jobs = n_jobs,
+                              max_memory = max_memory,
+                              backend = backend,
+                              svd_solver = svd_solver,
+                              max_components = max_components).fit(df_normal)
+
+    #the disease component of the tumour data, with the genes and columns kept
+    DcT_df = model.transform(df_tumour)
     
     Dc_mat = DcT_df
 
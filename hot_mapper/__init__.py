@@ -4,4 +4,7 @@ import hot_mapper.hotspot
 import hot_mapper.utils
 import hot_mapper.visualisation
 import hot_mapper.automated_parameter_search
-import hot_mapper.DSGA_transformation
\ No newline at end of file
+import hot_mapper.DSGA_transformation
+import hot_mapper.data_cache
+import hot_mapper.preprocessing
+import hot_mapper.survival
@@ -3,7 +3,13 @@ import hot_mapper.utils as utils
 import hot_mapper.hotspot as hotspot_algorithm
 import hot_mapper.random_lens as linear_lens_combination
 import hot_mapper.visualisation as mapper_plot
-from itertools import product
+import hot_mapper.survival as survival
+import numpy as np
+import pandas as pd
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 
 class Search():
     """This class searches across the Mapper parameters to identify the parameters that build a graph which contains a hotspot
@@ -16,16 +22,197 @@ class Search():
 
     runs: into
         How many times to run the search for a lens
+
+    max_cached_clusterings : int, default: ``4096``
+        Number of interval clusterings reused across the interval/overlap grid, see mapper.ClusteringCache.
+        The hit and miss counts are available from clustering_cache, including those of the worker processes when n_jobs > 1
             """
 
-    def __init__(self, X, runs = 1):
+    def __init__(self, X, runs = 1, max_cached_clusterings = 4096):
         self.X = X
         self.runs = runs
+        self.clustering_cache = mapper_algorithm.ClusteringCache(max_cached = max_cached_clusterings)
         self.parameters = {}
         self.parameter_lens = []
         self.parameter_samples = {}
 
-    def build_graphs(self, parameters, visualise = False):
+    def plan_grid(self, parameters):
+        """Plan the full lens x interval x overlap grid of the search.
+
+        Returns the lens settings of each run and the grid tasks in run order. Each task is a
+        (run, intervals) row of graphs across the overlap list, built incrementally in one worker"""
+
+        #generate a random lens from features for every run in one batch
+        if parameters["predefined_lens"] is None:
+            run_lenses = linear_lens_combination.Lenses(self.X, n_lenses = self.runs, nonzero_features = parameters["non_zero_lens_features"])
+            lenses = [{"lens": run_lenses["lens"][:,count],
+                       "weights": run_lenses["weights"][count],
+                       "feature_list": run_lenses["feature_list"][count],
+                       "lens_id": run_lenses["lens_ids"][count]} for count in range(self.runs)]
+
+        #a predefined lens may be given by its lens id
+        elif isinstance(parameters["predefined_lens"], str):
+            lenses = [linear_lens_combination.lens_from_id(self.X, parameters["predefined_lens"])] * self.runs
+        else:
+            lenses = [parameters["predefined_lens"]] * self.runs
+
+        tasks = [(count, i_param) for count in range(self.runs) for i_param in parameters["interval_list"]]
+        return lenses, tasks
+
+
+    def iter_grid(self, parameters, n_jobs = 1, visualise = False, plan = None, keep_graphs = False):
+        """Search the planned grid and yield the result of each graph as it completes.
+
+        With n_jobs of 0 or 1 the graphs are built lazily in this process, in grid order. Otherwise the grid
+        rows are dispatched to a pool of n_jobs worker processes (all cores for -1) in run order, and
+        results are yielded in completion order. Closing the generator cancels the rows not yet started,
+        and the workers stop their current row after the graph they are building.
+
+        Each result is a dictionary of the run, lens_id, intervals, overlap, grid_index, the hotspots found
+        (lists of nodes) and the samples in each hotspot. plan is the output of plan_grid, planned here when not given.
+        With keep_graphs = True each result also holds the graph and its node_membership"""
+
+        lenses, tasks = self.plan_grid(parameters) if plan is None else plan
+        overlap_list = list(parameters["overlap_list"])
+        grid_index = {i_param: n for n, i_param in enumerate(parameters["interval_list"])}
+
+        def results(count, i_param, row):
+            for n, (o_param, hotspots, sample_list, graph) in enumerate(row):
+                result = {"run": count,
+                          "lens_id": lenses[count].get("lens_id"),
+                          "intervals": i_param,
+                          "overlap": o_param,
+                          "grid_index": grid_index[i_param] * len(overlap_list) + n,
+                          "hotspots": hotspots,
+                          "samples": sample_list}
+                if keep_graphs:
+                    result["graph"], result["node_membership"] = graph
+                yield result
+
+        if 0 <= n_jobs <= 1:
+            for count, i_param in tasks:
+                for graph_result in _iter_lens_row(self.X, lenses[count]["lens"], i_param, overlap_list, parameters,
+                                                   cache = self.clustering_cache, visualise = visualise, keep_graphs = keep_graphs):
+                    yield from results(count, i_param, [graph_result])
+            return
+
+        #set when the generator is closed, so workers stop between graphs
+        stop = multiprocessing.Event()
+        executor = ProcessPoolExecutor(max_workers = None if n_jobs < 0 else n_jobs,
+                                       initializer = _initialise_search_worker,
+                                       initargs = (self.X, self.clustering_cache.max_cached, stop))
+        try:
+            futures = {executor.submit(_search_lens_row_in_worker, lenses[count]["lens"], i_param, overlap_list, parameters, keep_graphs): (count, i_param)
+                       for count, i_param in tasks}
+            for future in as_completed(futures):
+                count, i_param = futures[future]
+                row, hits, misses = future.result()
+
+                #each worker has its own cache, so its counts are added to the search's cache
+                self.clustering_cache.hits += hits
+                self.clustering_cache.misses += misses
+                yield from results(count, i_param, row)
+        finally:
+            stop.set()
+            executor.shutdown(wait = True, cancel_futures = True)
+
+
+    def iter_hotspots(self, parameters, accept = None, n_jobs = 1, plan = None):
+        """Search the grid and yield each hotspot accepted by the acceptance criterion as soon as its graph is searched.
+
+        Parameters
+        ----------
+
+        accept : function, default: ``None``
+            Called with each hotspot and returns True to accept it, for example a log-rank p-value below a threshold.
+            Every hotspot is accepted when None
+
+        n_jobs : int, default: ``1``
+            Number of worker processes, see iter_grid
+
+        plan : tuple, default: ``None``
+            Output of plan_grid, so the lenses searched are the ones given. Planned here when None
+
+        Each hotspot is a dictionary of the run, lens_id, intervals, overlap, nodes and samples of the hotspot.
+        Stop the search, including its workers, by closing the generator or leaving the loop over it"""
+
+        grid = self.iter_grid(parameters, n_jobs = n_jobs, plan = plan)
+        try:
+            for result in grid:
+                for nodes, samples in zip(result["hotspots"], result["samples"]):
+                    hotspot = {"run": result["run"],
+                               "lens_id": result["lens_id"],
+                               "intervals": result["intervals"],
+                               "overlap": result["overlap"],
+                               "nodes": nodes,
+                               "samples": samples}
+                    if accept is None or accept(hotspot):
+                        yield hotspot
+        finally:
+            grid.close()
+
+
+    def permutation_test(self, parameters, durations, event_observed, attribute, n_permutations = 1000,
+                         batch_size = 100, n_jobs = 1, random_state = None):
+        """Permutation test of the survival difference of the hotspots found across the grid, accounting for their
+        selection by the search.
+
+        Every graph of the grid is built once and kept. Each permutation shuffles the survival times and events
+        together across the samples, recomputes the attribute function from the permuted labels, searches every
+        graph for hotspots again and scores the hotspots found with the log-rank test of the permuted labels.
+        The corrected p-value of a hotspot is the fraction of permutations whose largest statistic of any hotspot
+        found reaches its statistic, so it accounts for every graph and lens the search tried, and for the hotspots
+        having been selected with the same survival labels. The graphs are built as by iter_grid, and batches of
+        permutations run in a pool of n_jobs worker processes when n_jobs > 1, see utils.permutation_batches.
+
+        Parameters
+        ----------
+
+        durations, event_observed : array
+            Survival time and event of each sample of X
+
+        attribute : function
+            Returns the attribute function of each sample from the durations and event_observed arrays, e.g. the
+            events before 10 years. It replaces parameters["attribute_function"], and must be defined at module
+            level when n_jobs > 1
+
+        Returns a dataframe with the run, lens_id, intervals, overlap and nodes of each hotspot with its log-rank
+        score and corrected_p_value, also kept as permutation_results"""
+
+        durations = np.asarray(durations, dtype=float)
+        event_observed = np.asarray(event_observed, dtype=float)
+        parameters = dict(parameters, attribute_function = np.asarray(attribute(durations, event_observed), dtype=float))
+        search = (parameters["epsilon"], parameters["min_samples"], parameters["extreme"])
+
+        #build and search every graph of the grid once, keeping the graphs for the permutations
+        grid = sorted(self.iter_grid(parameters, n_jobs = n_jobs, keep_graphs = True),
+                      key = lambda r: (r["run"], r["grid_index"]))
+        hotspot_searches = [hotspot_algorithm.HotspotSearch(mapper_graph = result["graph"],
+                                                            attribute_function = parameters["attribute_function"],
+                                                            samples_in_nodes = result["node_membership"])
+                            for result in grid]
+
+        hotspots = [{"run": result["run"],
+                     "lens_id": result["lens_id"],
+                     "intervals": result["intervals"],
+                     "overlap": result["overlap"],
+                     "nodes": nodes} for result in grid for nodes in result["hotspots"]]
+        scores = survival.LogRankScorer(durations, event_observed).score([samples for result in grid for samples in result["samples"]])
+        statistic = scores["test_statistic"].to_numpy()
+
+        null_max = utils.permutation_batches(partial(_permuted_search_statistics, hotspot_searches, durations, event_observed, attribute, search), n_permutations,
+                                             batch_size = batch_size, n_jobs = n_jobs, random_state = random_state)
+        null_max = np.concatenate(null_max)
+
+        scores["corrected_p_value"] = np.where(np.isnan(statistic), np.nan,
+                                               (1 + np.sum(null_max[:,None] >= statistic, axis=0)) / (n_permutations + 1))
+
+        found = pd.DataFrame(hotspots, columns = ["run", "lens_id", "intervals", "overlap", "nodes"])
+        self.permutation_results = pd.concat([found, scores], axis=1)
+        return self.permutation_results
+
+
+    def build_graphs(self, parameters, visualise = False, n_jobs = 1, accept = None):
         """Search through the parameter options and build mapper graphs
 
         Parameters
@@ -34,78 +221,183 @@ class Search():
         parameters : dictionary
             Dictionary of parameter options.
             Must include lens / clustering algorithm / interval list / overlap list / epsilon / minimum sample size / attribute function / hotspot extremity
+
+        n_jobs : int, default: ``1``
+            Number of worker processes building the graphs of the grid, see iter_grid. Graphs are only
+            visualised with n_jobs = 1. The runs are still checked in order, stopping at the first run with hotspots
+
+        accept : function, default: ``None``
+            Acceptance criterion of a hotspot, see iter_hotspots. When given, the search stops at the first accepted
+            hotspot of any run, which is the only hotspot saved
         """
 
         #Runs = lens space
         count = 0
         print('Testing Testing')
-        signficance = False
+        significance = False
         print("Building parameters and searching for hotspots")
+
+        plan = self.plan_grid(parameters)
+        lenses = plan[0]
+
+        #stop the grid and its workers at the first hotspot meeting the acceptance criterion
+        if accept is not None:
+            hotspots = self.iter_hotspots(parameters, accept = accept, n_jobs = n_jobs, plan = plan)
+            hotspot = next(hotspots, None)
+            hotspots.close()
+            if hotspot is None:
+                print(F"\nCompleted {self.runs} searches")
+                return
+
+            i_param, o_param = hotspot["intervals"], hotspot["overlap"]
+            random_lens = lenses[hotspot["run"]]
+            self.parameters[(i_param,o_param)] = [hotspot["nodes"]]
+            self.parameter_lens = {"lens": random_lens["lens"],
+                                    "weights": random_lens["weights"],
+                                    "feature_list": random_lens["feature_list"],
+                                    "lens_id": random_lens.get("lens_id")}
+            self.parameter_samples[(i_param,o_param)] = [hotspot["samples"]]
+            print("\nHotspots search successful")
+            return
+        n_graphs = len(parameters["interval_list"]) * len(parameters["overlap_list"])
+
+        #results of the grid arrive in completion order, and are gathered by run
+        grid = self.iter_grid(parameters, n_jobs = n_jobs, visualise = visualise and 0 <= n_jobs <= 1, plan = plan)
+        run_results = {}
+
         while count < self.runs:
-            if signficance == False:
-                #generate a random lens from features
-                if parameters["predefined_lens"] is None:
-                    random_lens = linear_lens_combination.Lens(self.X, nonzero_features = parameters["non_zero_lens_features"])
-                else: 
-                    random_lens = parameters["predefined_lens"]
-                    
-                #build a grid of interval and overlap combinations
-                io_list = list(product(parameters["interval_list"], parameters["overlap_list"]))
-
-                #for each grid combination of the interval & overlap, search lens for hotspot
-                for i in io_list:
-                    #define intervals and overlap
-                    i_param = i[0]
-                    o_param = i[1]
-
-                    # Run a clustering algorithm and build the graph
-                    mapper = mapper_algorithm.MapperGraph(data = self.X,
-                                                            lens_function = random_lens["lens"],
-                                                            intervals = i_param,
-                                                            overlap = o_param,
-                                                            clustering_algorithm = parameters["clustering_algorithm"],
-                                                            text = False)
-
-                    #build the graph with edges and nodes
-                    mapper.build_graph()
-
-                    #visualise graph
-                    if visualise == True:
-                        mapper_plot.draw_graph(mapper_graph = mapper.graph,
-                                        attribute_function = parameters["attribute_function"],
-                                        samples_in_nodes = mapper.samples_in_nodes,
-                                        size = 5,
-                                        style = 2,
-                                        labels = False)
-
-                    #run hotspot detection
-                    hotspot_search = hotspot_algorithm.HotspotSearch(mapper_graph = mapper.graph,
-                                                 attribute_function = parameters["attribute_function"],
-                                                 samples_in_nodes = mapper.samples_in_nodes)
-
-                    hotspots = hotspot_search.search_graph(attribute_threshold = parameters["epsilon"],
-                                                                min_sample_size = parameters["min_samples"],
-                                                                attribute_extreme = parameters["extreme"])
-
-                    #return list of samples in each hotspot found
-                    sample_list = []
-                    for n in hotspots:
-                        sample_list.append(utils.sample_index_in_nodes(mapper.samples_in_nodes, n))
+            if significance == False:
+                #take the random lens for this run
+                random_lens = lenses[count]
+
+                #wait for every graph of this run
+                while len(run_results.get(count, [])) < n_graphs:
+                    result = next(grid)
+                    run_results.setdefault(result["run"], []).append(result)
 
+                #for each grid combination of the interval & overlap, in grid order
+                for result in sorted(run_results.pop(count), key = lambda r: r["grid_index"]):
+                    i_param = result["intervals"]
+                    o_param = result["overlap"]
+                    hotspots = result["hotspots"]
 
                     #if hotspot present, save properties
                     if any(hotspots):
-                        
+
                         self.parameters[(i_param,o_param)] = hotspots # list of hotspots
-                        self.parameter_lens = {"weights": random_lens["weights"],
-                                                "feature_list": random_lens["feature_list"]}
-                        self.parameter_samples[(i_param,o_param)] = sample_list
+                        self.parameter_lens = {"lens": random_lens["lens"],
+                                                "weights": random_lens["weights"],
+                                                "feature_list": random_lens["feature_list"],
+                                                "lens_id": random_lens.get("lens_id")}
+                        self.parameter_samples[(i_param,o_param)] = result["samples"]
                         significance = True
 
                 #if hotspots exist in the filter function search
                 if self.parameters:
+                    grid.close()
                     print("\nHotspots search successful")
                     return
                 else:
                     count += 1
                     print(F"\nCompleted {count} searches")
+
+        grid.close()
+
+
+
+def _iter_lens_row(X, lens, i_param, overlap_list, parameters, cache = None, visualise = False, stop = None, keep_graphs = False):
+    """Build the Mapper graphs of one lens and number of intervals across the overlap list, and search each graph for hotspots.
+    The graphs are built incrementally along the overlap list. Yields (overlap, hotspots, samples in each hotspot, graph) for each graph,
+    until the stop event is set. graph is the (graph, node membership) pair with keep_graphs = True, otherwise None"""
+
+    mapper = None
+    for o_param in overlap_list:
+        if stop is not None and stop.is_set():
+            return
+
+        # Run a clustering algorithm and build the graph
+        if mapper is None:
+            mapper = mapper_algorithm.MapperGraph(data = X,
+                                                    lens_function = lens,
+                                                    intervals = i_param,
+                                                    overlap = o_param,
+                                                    clustering_algorithm = parameters["clustering_algorithm"],
+                                                    text = False,
+                                                    cache = cache)
+
+            #build the graph with edges and nodes
+            mapper.build_graph()
+
+        #the lens is unchanged along the row, so only the intervals whose samples change are clustered again
+        else:
+            mapper = mapper.rebuild(intervals = i_param, overlap = o_param)
+
+        #visualise graph
+        if visualise == True:
+            mapper_plot.draw_graph(mapper_graph = mapper.graph,
+                            attribute_function = parameters["attribute_function"],
+                            samples_in_nodes = mapper.node_membership,
+                            size = 5,
+                            style = 2,
+                            labels = False)
+
+        #run hotspot detection
+        hotspot_search = hotspot_algorithm.HotspotSearch(mapper_graph = mapper.graph,
+                                     attribute_function = parameters["attribute_function"],
+                                     samples_in_nodes = mapper.node_membership)
+
+        hotspots = hotspot_search.search_graph(attribute_threshold = parameters["epsilon"],
+                                                    min_sample_size = parameters["min_samples"],
+                                                    attribute_extreme = parameters["extreme"])
+
+        #return list of samples in each hotspot found
+        sample_list = []
+        for n in hotspots:
+            sample_list.append(utils.sample_index_in_nodes(mapper.node_membership, n))
+
+        yield (o_param, hotspots, sample_list, (mapper.graph, mapper.node_membership) if keep_graphs else None)
+
+
+#data, clustering cache and stop event of a search worker process, set once when the worker starts
+_worker_state = {}
+
+def _initialise_search_worker(X, max_cached, stop):
+    _worker_state["X"] = X
+    _worker_state["cache"] = mapper_algorithm.ClusteringCache(max_cached = max_cached)
+    _worker_state["stop"] = stop
+
+
+def _search_lens_row_in_worker(lens, i_param, overlap_list, parameters, keep_graphs = False):
+    """Search one grid row in a worker. Returns the row results with the cache hits and misses of the row"""
+
+    cache = _worker_state["cache"]
+    hits, misses = cache.hits, cache.misses
+    row = list(_iter_lens_row(_worker_state["X"], lens, i_param, overlap_list, parameters,
+                              cache = cache, stop = _worker_state["stop"], keep_graphs = keep_graphs))
+    return row, cache.hits - hits, cache.misses - misses
+
+
+def _permuted_search_statistics(hotspot_searches, durations, event_observed, attribute, search, seed, n_permutations):
+    """Largest log-rank statistic of the hotspots found across the graphs in each of a batch of permutations of the
+    survival labels, with the attribute function recomputed from the permuted labels. -inf for permutations without hotspots"""
+
+    rng = np.random.default_rng(seed)
+    permutations = [rng.permutation(len(durations)) for b in range(n_permutations)]
+    attributes = np.column_stack([np.asarray(attribute(durations[p], event_observed[p]), dtype=float) for p in permutations])
+
+    #search every graph with the node attributes of the whole batch averaged in one sparse product
+    hotspot_samples = [[] for b in range(n_permutations)]
+    for hotspot_search in hotspot_searches:
+        node_attributes = utils.aggregate_node_attributes(hotspot_search.node_membership, attributes, statistics = ["mean"]).to_numpy()
+        for b in range(n_permutations):
+            replicate = copy.copy(hotspot_search)
+            replicate.node_attribute = list(node_attributes[:,b])
+            for nodes in replicate.search_graph(*search):
+                hotspot_samples[b].append(utils.sample_index_in_nodes(hotspot_search.node_membership, nodes))
+
+    null_max = np.full(n_permutations, -np.inf)
+    for b, p in enumerate(permutations):
+        if hotspot_samples[b]:
+            statistic = survival.LogRankScorer(durations[p], event_observed[p]).score(hotspot_samples[b])["test_statistic"].to_numpy()
+            null_max[b] = np.max(np.nan_to_num(statistic, nan=-np.inf))
+    return null_max
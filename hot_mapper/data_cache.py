@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+
+A module to read and write the gene expression matrices of the pipeline (samples or genes as rows, index in the first column).
+
+CSV files are parsed once and cached in a binary format (.npy or .parquet), keyed on a hash of the CSV file contents.
+Later reads of an unchanged CSV file load the cached copy instead of parsing the text again. Matrices whose columns do
+not share one numeric dtype (e.g. a column of gene names) are cached as .parquet when .npy is requested.
+
+"""
+
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+
+def file_hash(file_name, block_size = 1 << 23):
+    """Return the sha256 hash of a file, read in blocks"""
+
+    h = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+#version of the cached copies, changed when the values cached for the same CSV contents change
+_CACHE_VERSION = "rt"
+
+def _cache_key(file_name, float32):
+    """Key of the cached copy of a CSV file, from a hash of its contents and the cache options"""
+
+    return file_hash(file_name)[:16] + "_" + _CACHE_VERSION + ("_f32" if float32 else "")
+
+
+def _cache_path(file_name, cache_dir, key, cache_format):
+    """Cache file for a CSV file, named after the CSV file and its cache key"""
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_name)), ".hot_mapper_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(cache_dir, F"{stem}-{key}.{cache_format}")
+
+
+def _read_csv(file_name):
+    """Parse a CSV matrix with the float values read back exactly as written"""
+
+    return pd.read_csv(file_name, sep = ",", index_col = 0, float_precision = "round_trip")
+
+
+def _to_float32(df):
+    """Convert the float columns of a dataframe to float32"""
+
+    float_columns = df.select_dtypes("float").columns
+    if len(float_columns) == df.shape[1]:
+        return df.astype(np.float32)
+    return df.astype({c: np.float32 for c in float_columns})
+
+
+def _label_array(labels):
+    """Index labels as an array that loads without pickle, numeric labels are kept and others stored as strings"""
+
+    labels = labels.to_numpy()
+    if labels.dtype == object:
+        return labels.astype(str)
+    return labels
+
+
+def _npy_compatible(df):
+    """True if all columns of a dataframe share one numeric dtype, so the values are stored as a plain .npy array"""
+
+    dtypes = set(df.dtypes)
+    return len(dtypes) == 1 and pd.api.types.is_numeric_dtype(dtypes.pop())
+
+
+def _cache_format_for(df, cache_format):
+    """Binary format to cache a dataframe in, .parquet when the values cannot be stored as .npy"""
+
+    if cache_format == "npy" and not _npy_compatible(df):
+        return "parquet"
+    return cache_format
+
+
+def save_matrix(df, file_name):
+    """Save a dataframe according to the file extension (.npy, .parquet or .csv).
+
+    A .npy matrix stores the values in file_name and the index and column labels in a
+    .labels.npz file alongside it. The values must share one numeric dtype, otherwise a
+    ValueError is raised before any file is written"""
+
+    if file_name.endswith(".npy"):
+        if not _npy_compatible(df):
+            raise ValueError(F"{file_name}: columns of dtypes {sorted(set(map(str, df.dtypes)))} cannot be saved as .npy, use .parquet")
+        np.save(file_name, df.to_numpy())
+        np.savez(file_name[:-len(".npy")] + ".labels.npz",
+                 index = _label_array(df.index),
+                 columns = _label_array(df.columns),
+                 index_name = np.array("" if df.index.name is None else str(df.index.name)))
+
+    elif file_name.endswith(".parquet"):
+        df.to_parquet(file_name)
+
+    else:
+        df.to_csv(file_name)
+
+
+def load_matrix(file_name, mmap_mode = None):
+    """Load a dataframe saved with save_matrix. mmap_mode is passed to np.load for .npy matrices"""
+
+    if file_name.endswith(".npy"):
+        values = np.load(file_name, mmap_mode=mmap_mode)
+        with np.load(file_name[:-len(".npy")] + ".labels.npz", allow_pickle=False) as labels:
+            index = pd.Index(labels["index"], name = str(labels["index_name"]) or None)
+            columns = labels["columns"]
+        return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+    elif file_name.endswith(".parquet"):
+        return pd.read_parquet(file_name)
+
+    else:
+        return _read_csv(file_name)
+
+
+def read_matrix(file_name, cache_dir = None, float32 = False, cache_format = "npy"):
+    """Read a CSV matrix through the binary cache, parsing the CSV file only when no cached copy of its contents exists
+
+    Parameters
+    ----------
+
+    cache_dir : str, default: ``None``
+        Directory of cached matrices. Defaults to a .hot_mapper_cache directory beside the CSV file
+
+    float32 : boolean, default: ``False``
+        Store and return the float columns as float32
+
+    cache_format : ["npy"],["parquet"], default: ``"npy"``
+        Binary format of the cached matrix. Matrices that cannot be stored as .npy are cached as .parquet
+        """
+
+    #a .npy cache falls back to .parquet for matrices with non-numeric or mixed dtype columns
+    key = _cache_key(file_name, float32)
+    for cached_format in dict.fromkeys([cache_format, "parquet"]):
+        cache_file = _cache_path(file_name, cache_dir, key, cached_format)
+        if os.path.exists(cache_file):
+            return load_matrix(cache_file)
+
+    #the values cached are those written to the CSV file, whether parsed here or stored by write_matrix
+    df = _read_csv(file_name)
+    if float32 == True:
+        df = _to_float32(df)
+
+    save_matrix(df, _cache_path(file_name, cache_dir, key, _cache_format_for(df, cache_format)))
+    return df
+
+
+def write_matrix(df, file_name, cache_dir = None, float32 = False, cache_format = "npy", write_csv = True):
+    """Write a matrix to a CSV file and store the binary cached copy, so that the next read_matrix of the file does not parse it.
+    The cached copy holds the exact values written rather than their parsed text. With write_csv = False only the binary copy is written, to file_name with its extension replaced by the cache format
+    (.parquet when the matrix cannot be stored as .npy)"""
+
+    if write_csv == False:
+        if float32 == True:
+            df = _to_float32(df)
+        save_matrix(df, os.path.splitext(file_name)[0] + "." + _cache_format_for(df, cache_format))
+        return
+
+    df.to_csv(file_name)
+
+    #column labels are read back from a CSV file as strings
+    df = df.set_axis(df.columns.astype(str), axis=1)
+    if float32 == True:
+        df = _to_float32(df)
+    save_matrix(df, _cache_path(file_name, cache_dir, _cache_key(file_name, float32), _cache_format_for(df, cache_format)))
@@ -4,12 +4,15 @@ import hot_mapper.utils as hmu
 import hot_mapper.visualisation as hmv
 import hot_mapper.utils as utils
 
+import copy
 import numpy as np
 import networkx as nx
 import pandas as pd
+from functools import partial
 from statsmodels import robust
 from itertools import compress
-from scipy.spatial import distance
+import scipy.sparse as sp
+from scipy.sparse import csgraph
 from scipy.cluster import hierarchy
 
 
@@ -29,6 +32,9 @@ class HotspotSearch:
     """ The hotspot class searches a collection of interconnected nodes
     obtained from the Mapper grah, identifying any clusters of nodes that
     present anomalous attribute filter_values
+
+    samples_in_nodes is the samples x nodes membership of the Mapper graph, either the
+    samples_in_nodes dataframe or the sparse node_membership matrix of MapperGraph
         """
 
 
@@ -38,10 +44,11 @@ class HotspotSearch:
         #labels for original mapper. labels retained in nx attributes'_node'
         self.graph = mapper_graph
         self.samples_in_nodes = samples_in_nodes
+        self.node_membership = utils.node_membership_matrix(samples_in_nodes)
 
         #if attribute function provided as values for each sample, average per node
         if len(attribute_function) == samples_in_nodes.shape[0]:
-            self.node_attribute = utils.colour_nodes_by_attribute(samples_in_nodes, attribute_function)
+            self.node_attribute = utils.colour_nodes_by_attribute(self.node_membership, attribute_function)
 
         elif len(attribute_function) == samples_in_nodes.shape[1]: 
             self.node_attribute = attribute_function
@@ -50,90 +57,67 @@ class HotspotSearch:
             print("attribute size wrong length: must be value for each sample or value for each node")
 
     def _calculate_edge_weights(self):
-        #assigns edge weights for every pair of edges in the original graph
-        edge_weights = {}
-        graph_copy = self.graph.copy()
-        for e in graph_copy.edges():
-            #find the absolute difference in nodes
-            node_difference = abs(self.node_attribute[e[0]] - self.node_attribute[e[1]])
-            graph_copy[e[0]][e[1]]['weight'] = node_difference #assign as edge weight
-            edge_weights[(e[0],e[1])] = node_difference
-        return edge_weights
-
+        """Return the edges of the graph as an array of node positions (edges x 2) in the node order of the graph,
+        and an aligned array of edge weights, the absolute difference in attribute between the nodes"""
 
+        nodes = list(self.graph.nodes)
+        position = {n: i for i, n in enumerate(nodes)}
+        edges = np.array([(position[u], position[v]) for u, v in self.graph.edges], dtype=int).reshape(-1, 2)
 
-    def _seperate_graph_connected_components(self, graph):
-        """Hotspot detection is performed for each seperate component of the graph. These
-        are converted to seperate networkx subgraphs"""
+        node_attribute = np.asarray(self.node_attribute, dtype=float)[np.asarray(nodes, dtype=int)] if nodes else np.empty(0)
+        edge_weights = np.abs(node_attribute[edges[:,0]] - node_attribute[edges[:,1]])
+        return edges, edge_weights
 
-        connected_components = {i:graph.subgraph(c).copy() for i,c in enumerate(nx.connected_components(graph))}
-        return connected_components
 
 
+    def _seperate_graph_connected_components(self, n_nodes, edges):
+        """Hotspot detection is performed for each seperate component of the graph. Returns the component of
+        each node position, with components numbered in order of their first node"""
 
-    def _sort_subgraph_edge_weights(self, subgraph, edge_weights):
+        adjacency = sp.coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), shape=(n_nodes, n_nodes))
+        n_components, labels = csgraph.connected_components(adjacency, directed=False)
 
-        # #subset edges and weights to those in the subgraph
-        subgraph_edge_weights = {}
-        for k in subgraph.edges:
-            try:
-                subgraph_edge_weights[k] = edge_weights[k]
+        #number the components in order of their first node
+        first = np.unique(labels, return_index=True)[1]
+        rank = np.empty(n_components, dtype=int)
+        rank[np.argsort(first)] = np.arange(n_components)
+        return rank[labels]
 
-            #if edge order has swapped try reversing key
-            except KeyError:
-                k_rev = (k[1],k[0])
-                subgraph_edge_weights[k_rev] = edge_weights[k_rev]
 
 
-        #sort labels in order of ascending weight
-        subgraph_edge_weights_sorted = {k: v for k, v in sorted(subgraph_edge_weights.items(), key=lambda item: item[1])}
+    def _sort_subgraph_edge_weights(self, edge_component, edge_weights, n_components):
+        """Order of the edges grouped by component and in order of ascending weight within each component,
+        and the bounds of each component in this order"""
 
-        return subgraph_edge_weights_sorted
+        order = np.lexsort((edge_weights, edge_component))
+        bounds = np.searchsorted(edge_component[order], np.arange(n_components + 1))
+        return order, bounds
 
 
 
 
-    def _identify_edge_cut_off(self, subgraph, edge_weights, plot_dendrogram = False):
+    def _identify_edge_cut_off(self, component_nodes, edges_sorted, edge_weights_sorted, plot_dendrogram = False):
         """ Define edge weights according to the difference in attribute value between nodes.
             Sort the edge weights, then identify the cut-off point to build the clusters - between the
             edge weights with the largest difference in values"""
 
         #only define cutoff if more than one node is present, as otherwise no edges exist
 
-        if len(subgraph.nodes) == 1:
+        if len(component_nodes) == 1:
             cutoff = 1
 
         else:
-            #return the edge weights found in the new subgraph
-            edge_weights_sorted = self._sort_subgraph_edge_weights(subgraph, edge_weights)
-            #empty matrix of node length x needed for linkage tree
-            a = pd.DataFrame(1.0, index= subgraph.nodes, columns=subgraph.nodes)
-
-            #construct matrix of nodes and edges
-            for i,j in edge_weights_sorted.items():
-                u = i[0]
-                v = i[1]
-                a.loc[u,v] = j
-                a.loc[v,u] = j
-                a.loc[u,u] = 0.0
-                a.loc[v,v] = 0.0
-
-            #construct a single linkage matrix of connected node
-            dists = distance.squareform(a)
-            Z = hierarchy.linkage(dists)
-            
-            #retain the threshold for edge cutoff and get the edge weight values from the dict
+            #retain the threshold for edge cutoff from the sorted edge weights
             #find the differences between all the values. We ignore the very last value
-            edge_differences = list(edge_weights_sorted.values())
-            edge_difference_distances = [j-i for i, j in zip(edge_differences[:-2], edge_differences[1:])]
+            edge_differences = edge_weights_sorted
+            edge_difference_distances = np.diff(edge_differences)[:len(edge_differences)-2]
 
             #find the maximum difference and the index
-            try:
-                m = max(edge_difference_distances)
-                max_index = edge_difference_distances.index(m)
-                cut_index = max_index
+            if len(edge_difference_distances):
+                cut_index = int(np.argmax(edge_difference_distances))
+                m = edge_difference_distances[cut_index]
 
-            except ValueError:
+            else:
                 m = 0
                 cut_index = 0
 
@@ -145,8 +129,11 @@ class HotspotSearch:
 
 
             if plot_dendrogram == True:
+                #construct a single linkage matrix of the connected nodes from the sorted edges
+                Z = _single_linkage(component_nodes, edges_sorted, edge_weights_sorted)
+
                 #specify the nodes contained in this subgraph
-                lab = list(subgraph.nodes())
+                lab = list(component_nodes)
                 print(Z)
                 print(lab)
                 print(cutoff)
@@ -175,29 +162,22 @@ class HotspotSearch:
         return cutoff
 
 
-    def _identify_attribute_clusters_below_cutoff(self, subgraph, edge_weights, cutoff):
+    def _identify_attribute_clusters_below_cutoff(self, nodes, edges, node_component, edge_cutoff):
         """Function seperates the graph into clusters according to the edge
-        weight cutoff point. Any edges above this threshold are removed, leaving
-        a graph seperated into groups of similar node values"""
+        weight cutoff point of each component. Edges above the cutoff are dropped, leaving
+        the graph seperated into groups of similar node values. Returns the clusters of each
+        component, each cluster a list of nodes in graph order"""
 
-        #return the edge weights found in the new subgraph
-        edge_weights_sorted = self._sort_subgraph_edge_weights(subgraph, edge_weights)
+        cluster = self._seperate_graph_connected_components(len(nodes), edges[edge_cutoff])
 
-        #make a copy of the original subgraph
-        graph_copy = subgraph.copy()
+        #clusters lie within one component, so are listed by component in order of their first node
+        order = np.lexsort((np.arange(len(nodes)), cluster))
+        bounds = np.flatnonzero(np.diff(cluster[order])) + 1
+        community_cluster_nodes = [[] for c in range(node_component.max() + 1 if len(nodes) else 0)]
+        for members in np.split(order, bounds) if len(nodes) else []:
+            community_cluster_nodes[node_component[members[0]]].append([nodes[i] for i in members])
 
-        #identify the any edges above the cut-off
-        remove_edges = [i for i in edge_weights_sorted if edge_weights_sorted[i] > cutoff]
-
-        #remove these values from the graph
-        for e1,e2 in remove_edges:
-            graph_copy.remove_edge(e1,e2)
-
-        #map between the old and new labels
-        communities = self._seperate_graph_connected_components(graph_copy)
-        cluster_nodes = [list(cluster.nodes) for cluster in list(communities.values())]
-        
-        return(cluster_nodes)
+        return community_cluster_nodes
 
 
     def _find_attribute_value_of_node_cluster(self, nodes):
@@ -210,17 +190,15 @@ class HotspotSearch:
 
     def _find_no_samples_in_nodes(self, nodes):
         """Function finds the sample size for specified nodes in the Mapper graph"""
-        return np.sum(self.samples_in_nodes[nodes].max(axis=1))
+        return utils.count_samples_in_nodes(self.node_membership, nodes)
 
 
-    def _cluster_classification(self, subgraph, community_clusters, attribute_threshold, min_sample_size, attribute_extreme = "either"):
+    def _cluster_classification(self, component, community_clusters, attribute_threshold, min_sample_size, attribute_extreme = "either"):
         ## Set up the hotspot dictionary containing information for each subgraph ##
         hotspot = {}
         hotspot_class = [True]*len(community_clusters)
 
-        #find all the nodes in this graph community
-        component = subgraph.nodes
-
+        #component holds all the nodes in this graph community
         for i,cluster in enumerate(community_clusters):
 
             #find neighbour nodes - the other remaining nodes in the component
@@ -271,20 +249,31 @@ class HotspotSearch:
 
     def search_graph(self, attribute_threshold, min_sample_size, attribute_extreme = "either", plot_dendrogram = False):
         #calculate the weight of the edges as the difference in attribute between the nodes
-        edge_weights = self._calculate_edge_weights()
-        
-        #identify subgraphs of connected components in networkx graph
-        subgraphs = self._seperate_graph_connected_components(self.graph)
+        nodes = list(self.graph.nodes)
+        edges, edge_weights = self._calculate_edge_weights()
         
-
-        #for each subgraph identify the cut-off point between edges
-        subgraph_cutoffs = [self._identify_edge_cut_off(subgraphs[i], edge_weights, plot_dendrogram = plot_dendrogram) for i in subgraphs]
+        #identify the connected components of the graph
+        node_component = self._seperate_graph_connected_components(len(nodes), edges)
+        edge_component = node_component[edges[:,0]]
+        components = [[] for c in range(node_component.max() + 1 if nodes else 0)]
+        for i, c in enumerate(node_component):
+            components[c].append(nodes[i])
+
+        #sort the edges of all components once, then for each component identify the cut-off point between edges
+        order, bounds = self._sort_subgraph_edge_weights(edge_component, edge_weights, len(components))
+        edges_sorted = np.asarray(nodes, dtype=int)[edges[order]] if nodes else edges
+        edge_weights_sorted = edge_weights[order]
+        subgraph_cutoffs = np.array([self._identify_edge_cut_off(components[i],
+                                                                 edges_sorted[bounds[i]:bounds[i+1]],
+                                                                 edge_weights_sorted[bounds[i]:bounds[i+1]],
+                                                                 plot_dendrogram = plot_dendrogram) for i in range(len(components))])
 
         #identify the community clusters in the graph that lie below the attribute cut-off
-        community_cluster_nodes = [self._identify_attribute_clusters_below_cutoff(subgraphs[i], edge_weights, subgraph_cutoffs[i]) for i in subgraphs ]
+        below_cutoff = edge_weights <= subgraph_cutoffs[edge_component] if len(edges) else np.zeros(0, dtype=bool)
+        community_cluster_nodes = self._identify_attribute_clusters_below_cutoff(nodes, edges, node_component, below_cutoff)
 
         #classify each commmunity cluster in the graph as a hotspot or non-hotspot
-        hotspot_clusters = [self._cluster_classification(subgraphs[i], community_cluster_nodes[i], attribute_threshold, min_sample_size, attribute_extreme) for i in subgraphs]
+        hotspot_clusters = [self._cluster_classification(components[i], community_cluster_nodes[i], attribute_threshold, min_sample_size, attribute_extreme) for i in range(len(components))]
 
         #return flat list of hotspot nodes from all clusters in all components
         hotspot_nodes = [nodes for component in hotspot_clusters for nodes in component ]
@@ -293,6 +282,36 @@ class HotspotSearch:
 
 
 
+    def permutation_test(self, attribute_function, attribute_threshold, min_sample_size, attribute_extreme = "either",
+                         n_permutations = 1000, batch_size = 100, n_jobs = 1, random_state = None):
+        """Permutation test of the hotspots of the graph, shuffling the sample attribute function.
+
+        For each permutation the hotspots are searched again on the same graph and node membership, with the node
+        attributes of a batch of permutations averaged in one sparse product. The statistic of a hotspot is the difference
+        in mean attribute between its samples and the remaining samples, in the direction of attribute_extreme. Its
+        p-value is the fraction of permutations whose largest hotspot statistic reaches it, so it accounts for the hotspot
+        having been selected by the search. Batches run in a pool of n_jobs worker processes when n_jobs > 1, see
+        utils.permutation_batches.
+
+        Returns a dataframe with the nodes, statistic and p_value of each hotspot found with the attribute function"""
+
+        attribute = np.asarray(attribute_function, dtype=float)
+        search = (attribute_threshold, min_sample_size, attribute_extreme)
+
+        observed = copy.copy(self)
+        observed.node_attribute = utils.colour_nodes_by_attribute(self.node_membership, attribute)
+        hotspots = observed.search_graph(*search)
+        statistic = _hotspot_statistics(self.node_membership, attribute, hotspots, attribute_extreme)
+
+        null_max = utils.permutation_batches(partial(_permuted_hotspot_statistics, self, attribute, search), n_permutations,
+                                             batch_size = batch_size, n_jobs = n_jobs, random_state = random_state)
+        null_max = np.concatenate(null_max)
+
+        p_value = (1 + np.sum(null_max[:,None] >= statistic, axis=0)) / (n_permutations + 1)
+        return pd.DataFrame({"nodes": hotspots, "statistic": statistic, "p_value": p_value})
+
+
+
     def visualise_hotspots_in_graph(self, size = 10, style = 1, labels = False):
         #draw graph highlighting all hotspot nodes that may be present in each components
         #draw as seperate graphs
@@ -306,3 +325,70 @@ class HotspotSearch:
                           size = size,
                           style = style,
                           labels = labels)
+
+
+
+def _single_linkage(nodes, edges_sorted, edge_weights_sorted):
+    """Single linkage matrix, as returned by hierarchy.linkage, of the nodes of a connected component from its
+    edges in ascending order of weight. The merges are the minimum spanning tree of the edges (Kruskal's algorithm),
+    so only the edges are held rather than the distances between all pairs of nodes"""
+
+    index = {n: i for i, n in enumerate(nodes)}
+    n_nodes = len(nodes)
+    parent = list(range(n_nodes))
+    cluster = list(range(n_nodes))
+    size = [1] * n_nodes
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    Z = np.zeros((n_nodes - 1, 4))
+    merge = 0
+    for (u, v), weight in zip(edges_sorted, edge_weights_sorted):
+        root_u, root_v = find(index[u]), find(index[v])
+        if root_u == root_v:
+            continue
+
+        #join the clusters of the edge, listing the cluster with the smaller id first
+        parent[root_v] = root_u
+        size[root_u] += size[root_v]
+        Z[merge] = [min(cluster[root_u], cluster[root_v]), max(cluster[root_u], cluster[root_v]), weight, size[root_u]]
+        cluster[root_u] = n_nodes + merge
+        merge += 1
+        if merge == n_nodes - 1:
+            break
+
+    return Z
+
+
+def _hotspot_statistics(node_membership, attribute, hotspots, attribute_extreme):
+    """Difference in mean attribute between the samples of each hotspot and the remaining samples, signed so that
+    larger values are more extreme in the direction of attribute_extreme"""
+
+    statistic = []
+    for nodes in hotspots:
+        in_hotspot = np.asarray(node_membership[:,list(nodes)].sum(axis=1)).ravel() > 0
+        difference = np.mean(attribute[in_hotspot]) - np.mean(attribute[~in_hotspot])
+        statistic.append({"higher": difference, "lower": -difference, "either": abs(difference)}[attribute_extreme])
+    return np.array(statistic, dtype=float)
+
+
+def _permuted_hotspot_statistics(hotspot_search, attribute, search, seed, n_permutations):
+    """Largest hotspot statistic found in each of a batch of permutations of the attribute function,
+    -inf for permutations without hotspots"""
+
+    rng = np.random.default_rng(seed)
+    permuted = np.column_stack([rng.permutation(attribute) for b in range(n_permutations)])
+    node_attributes = utils.aggregate_node_attributes(hotspot_search.node_membership, permuted, statistics = ["mean"]).to_numpy()
+
+    null_max = np.full(n_permutations, -np.inf)
+    for b in range(n_permutations):
+        replicate = copy.copy(hotspot_search)
+        replicate.node_attribute = list(node_attributes[:,b])
+        hotspots = replicate.search_graph(*search)
+        if hotspots:
+            null_max[b] = np.max(_hotspot_statistics(hotspot_search.node_membership, permuted[:,b], hotspots, search[2]))
+    return null_max
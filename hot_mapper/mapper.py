@@ -4,6 +4,12 @@ import pandas as pd
 import sklearn.cluster as sklc
 from sklearn import manifold, decomposition
 import networkx as nx
+from itertools import product
+from collections import OrderedDict
+import hashlib
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
 
 #supporting python scripts
 import hot_mapper.utils as utils
@@ -16,36 +22,102 @@ from scipy.spatial import distance
 
 
 
-def _build_cover_on_lens_function(data, lens_function, intervals, overlap):
-    """Build a cover by dividing the lens into overlapping intervals and retrieve
-    the samples contained in each interval"""
-
-    #find the range of the lens function
-    lens_min = np.amin(lens_function)
-    lens_max = np.amax(lens_function)
+def _interval_bounds(lens_min, lens_max, intervals, overlap):
+    """Return the start and end points of the overlapping intervals covering [lens_min, lens_max]"""
 
     #calculate the size of each interval
     interval_length = (lens_max - lens_min) / (((intervals-1)  *  (1 - overlap)) + 1)
 
-    #the number of samples in the dataset
-    no_samples_in_data = np.array(range(data.shape[0]))
+    #the starting point of each interval is the start of the lens function
+    starts = np.array([lens_min + (i * interval_length) * (1 - overlap) for i in range(intervals)])
+    ends = starts + interval_length
 
-    #these are the fundamental properties of the intervals
-    interval_samples = [False for i in range(intervals)]
-    samples_in_interval = {}
+    #the last interval ends at the lens maximum, so rounding never leaves the largest sample uncovered
+    ends[-1] = max(ends[-1], lens_max)
+    return starts, ends
+
+
+def _sorted_interval_ranges(lens, starts, ends, order = None):
+    """Sort the lens once (unless its sort order is given) and find the contiguous range of sorted samples lying in each interval [ai, bi]"""
+
+    if order is None:
+        order = np.argsort(lens, kind="stable")
+    sorted_lens = lens[order]
+    lo = np.searchsorted(sorted_lens, starts, side="left")
+    hi = np.searchsorted(sorted_lens, ends, side="right")
+    return order, lo, hi
+
+
+def _build_hypercube_cover(lens_function, intervals, overlap):
+    """Build a hypercube cover of a k-dimensional lens from the product of overlapping intervals in each dimension.
+    Only the non-empty cells are returned, keyed by their tuple of interval indices"""
+
+    n_samples, n_dims = lens_function.shape
+    intervals = np.broadcast_to(intervals, n_dims).astype(int)
+    overlap = np.broadcast_to(overlap, n_dims).astype(float)
+
+    #in each dimension a sample lies in a contiguous run of intervals, from first to last
+    #(a sample rounded outside every interval keeps first > last and lies in no cell)
+    first = np.tile(intervals, (n_samples, 1))
+    last = np.full((n_samples, n_dims), -1)
     interval_sets = []
+    for d in range(n_dims):
+        lens = lens_function[:,d]
+        starts, ends = _interval_bounds(np.amin(lens), np.amax(lens), intervals[d], overlap[d])
+        interval_sets.append([[a, b] for a, b in zip(starts, ends)])
+        order, lo, hi = _sorted_interval_ranges(lens, starts, ends)
+        for i in reversed(range(intervals[d])):
+            first[order[lo[i]:hi[i]], d] = i
+        for i in range(intervals[d]):
+            last[order[lo[i]:hi[i]], d] = i
+
+    #enumerate each sample's cells as offsets from its first interval in every dimension
+    max_offset = np.maximum(np.amax(last - first, axis=0) + 1, 0)
+    sample_list, cell_list = [], []
+    for offset in product(*[range(m) for m in max_offset]):
+        cells = first + np.array(offset)
+        in_cell = np.all(cells <= last, axis=1)
+        sample_list.append(np.flatnonzero(in_cell))
+        cell_list.append(np.ravel_multi_index(cells[in_cell].T, intervals))
+
+    #group the samples of each non-empty cell, in sample order
+    samples = np.concatenate(sample_list)
+    cell_ids = np.concatenate(cell_list)
+    grouping = np.lexsort((samples, cell_ids))
+    samples, cell_ids = samples[grouping], cell_ids[grouping]
+    cell_keys, cell_starts = np.unique(cell_ids, return_index=True)
+    cell_samples = np.split(samples, cell_starts[1:])
+
+    samples_in_interval = {tuple(int(c) for c in np.unravel_index(k, intervals)): v for k, v in zip(cell_keys, cell_samples)}
+    return samples_in_interval, interval_sets
+
+
+def _build_cover_on_lens_function(data, lens_function, intervals, overlap, order = None):
+    """Build a cover by dividing the lens into overlapping intervals and retrieve
+    the samples contained in each interval.
 
-    for i in range (0, intervals):
-        #the starting point of each interval is the start of the lens function
-        ai = lens_min + (i * interval_length) * (1 - overlap)
-        bi = ai + interval_length
-        interval_sets.append([ai,bi])
-        #for each point, assign it to an interval if the function value
-        #of this point lies between interval start and end points
-        points_in_set = ((ai <= lens_function) & (lens_function <= bi))
-        samples = no_samples_in_data[points_in_set]
-        samples_in_interval[i] = np.unique(samples)
+    The lens is sorted once and the samples of each interval are found as a contiguous range
+    of the sorted order, returned as a view of it (in lens order rather than sample order).
+    The sort order of a previous cover of the same lens can be given as order.
+    A lens with several columns is covered by hypercubes, see _build_hypercube_cover"""
 
+    lens_function = np.asarray(lens_function)
+    if lens_function.ndim == 2 and lens_function.shape[1] > 1:
+        return _build_hypercube_cover(lens_function, intervals, overlap)
+    lens_function = lens_function.reshape(-1)
+
+    #find the range of the lens function
+    lens_min = np.amin(lens_function)
+    lens_max = np.amax(lens_function)
+
+    #these are the fundamental properties of the intervals
+    starts, ends = _interval_bounds(lens_min, lens_max, intervals, overlap)
+    interval_sets = [[ai, bi] for ai, bi in zip(starts, ends)]
+
+    #for each point, assign it to an interval if the function value
+    #of this point lies between interval start and end points
+    order, lo, hi = _sorted_interval_ranges(lens_function, starts, ends, order)
+    samples_in_interval = {i: order[lo[i]:hi[i]] for i in range(intervals)}
 
     return samples_in_interval, interval_sets
 
@@ -66,39 +138,172 @@ def _minimum_samples_for_clustering_algorithm(clustering_algorithm):
 
 
 
-def _cluster_data_in_intervals(data, intervals, clustering_algorithm, samples_in_interval):
+def _fit_cluster_labels(clustering_algorithm, points):
+    """Fit a fresh clone of the clustering algorithm to the points of one interval and return the labels"""
+    return clone(clustering_algorithm).fit(points).labels_
+
+
+class ClusteringCache():
+    """ The ClusteringCache class keeps the cluster labels of interval point sets, keyed on the set of sample
+    indices and the parameters of the clustering algorithm. Graphs built on the same data with different
+    intervals or overlap reuse the labels of intervals holding the same samples instead of refitting.
+    A cache must only be shared between graphs built on the same data.
+
+    Parameters
+    ----------
+
+    max_cached : int, default: ``4096``
+        Number of interval clusterings kept in memory, the least recently used are dropped first
+
+    Attributes
+    ----------
+
+    hits, misses : int
+        Number of interval clusterings found in and missing from the cache
+            """
+
+    def __init__(self, max_cached = 4096):
+        self.max_cached = max_cached
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+
+    def key(self, samples, clustering_algorithm):
+        """Content address of the clustering of the sorted sample indices by the clustering algorithm"""
+
+        params = sorted(clustering_algorithm.get_params().items())
+        h = hashlib.sha1(np.ascontiguousarray(samples, dtype=np.int64).tobytes())
+        h.update(repr((type(clustering_algorithm).__name__, params)).encode())
+        return h.hexdigest()
+
+
+    def get(self, key):
+        """Return the cached labels of a key, or None"""
+
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        return None
+
+
+    def store(self, key, labels):
+        self._cache[key] = labels
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+
+def _cluster_data_in_intervals(data, intervals, clustering_algorithm, samples_in_interval, n_jobs = 1, executor = None, cache = None, previous = None):
     """Perform clustering within each interval on the data in the original space.
     These clusters form nodes in the graph, and overlapping clusters are reperesented
-    by edges. """
+    by edges.
+
+    Each interval is clustered by its own clone of the clustering algorithm, so intervals can be
+    dispatched to an executor (or a process pool of n_jobs workers), largest interval first.
+    The clusters are returned in interval order, identical to clustering the intervals serially.
+    Intervals found in a ClusteringCache are not refitted, and intervals whose samples are keys of previous
+    (the _interval_content_key of the samples) take the clusters of a previous graph without clustering."""
 
     cluster_samples_in_interval = {}
-    n = 0 #n is the number of clusters at the start
-    n_i = 0 # n_i is the number of clusters generated in that interval set
     min_samples_in_cluster = _minimum_samples_for_clustering_algorithm(clustering_algorithm)
-    #for each interval, if there is more than two data points in that interval
-    #Fit a clustering algorithm to those datapoints
-    for i in range(0, intervals):
-        #access the unique samples within each interval
-        samples = samples_in_interval[i]
-        points =  data[samples]
 
-        #THIS SETS THE MIMINMUM NUMBER OF SAMPLES IN A NODE - we lose intervals if we do not incorporate nodes
-        if len(samples) > min_samples_in_cluster:
-            cl = clustering_algorithm.fit(points)
-            c_i = [samples[np.where(cl.labels_ == label)] for label in set(cl.labels_)]
-            cluster_samples_in_interval[i] = c_i
-        n =  n + n_i
-    return cluster_samples_in_interval
+    #for each interval (or hypercube cell), if there is more than two data points in that interval
+    #Fit a clustering algorithm to those datapoints
+    #access the unique samples within each interval, in sample order
+    interval_samples = {i: np.sort(samples_in_interval[i]) for i in sorted(samples_in_interval)}
+
+    #THIS SETS THE MIMINMUM NUMBER OF SAMPLES IN A NODE - we lose intervals if we do not incorporate nodes
+    clustered = [i for i in interval_samples if len(interval_samples[i]) > min_samples_in_cluster]
+
+    #keep the clusters of intervals unchanged since a previous graph
+    if previous:
+        for i in clustered:
+            key = _interval_content_key(interval_samples[i])
+            if key in previous:
+                cluster_samples_in_interval[i] = previous[key]
+    changed = [i for i in clustered if i not in cluster_samples_in_interval]
+
+    #reuse the labels of point sets already clustered
+    labels = {}
+    if cache is not None:
+        keys = {i: cache.key(interval_samples[i], clustering_algorithm) for i in changed}
+        for i in changed:
+            cached = cache.get(keys[i])
+            if cached is not None:
+                labels[i] = cached
+    to_fit = [i for i in changed if i not in labels]
+
+    if executor is None and n_jobs == 1:
+        for i in to_fit:
+            labels[i] = _fit_cluster_labels(clustering_algorithm, data[interval_samples[i]])
+
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers = None if n_jobs < 0 else n_jobs)
+        try:
+            #schedule the largest intervals first to reduce stragglers
+            largest_first = sorted(to_fit, key=lambda i: len(interval_samples[i]), reverse=True)
+            futures = {i: executor.submit(_fit_cluster_labels, clustering_algorithm, data[interval_samples[i]]) for i in largest_first}
+            for i in to_fit:
+                labels[i] = futures[i].result()
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    if cache is not None:
+        for i in to_fit:
+            cache.store(keys[i], labels[i])
+
+    for i in changed:
+        samples = interval_samples[i]
+        c_i = [samples[np.where(labels[i] == label)] for label in set(labels[i])]
+        cluster_samples_in_interval[i] = c_i
+    return {i: cluster_samples_in_interval[i] for i in clustered}
+
+
+def _interval_content_key(samples):
+    """Key of the sorted samples of an interval, equal for intervals holding the same samples"""
+    return np.ascontiguousarray(samples, dtype=np.int64).tobytes()
 
 
 #
-def _convert_sampleID_dict_to_matrix(data, ID_dictionary):
-    mtx = pd.DataFrame(0, index=np.arange(len(data)), columns=ID_dictionary.keys())
-    for node in ID_dictionary:
-        node_columns = mtx[node]
-        samples = ID_dictionary[node]
-        node_columns[samples] = 1
-    return mtx
+def _sample_membership_matrix(n_samples, ID_dictionary):
+    """Sparse boolean matrix with samples in rows and the keys of ID_dictionary in columns, true where the sample is in the node (or interval)"""
+
+    keys = list(ID_dictionary)
+    rows = np.concatenate([np.asarray(ID_dictionary[k], dtype=np.int64) for k in keys]) if keys else np.empty(0, dtype=np.int64)
+    columns = np.repeat(np.arange(len(keys)), [len(ID_dictionary[k]) for k in keys])
+    return sp.csc_matrix((np.ones(len(rows), dtype=bool), (rows, columns)), shape=(n_samples, len(keys)))
+
+
+def _membership_dataframe(membership, keys):
+    """Dense dataframe of a membership matrix, with samples in rows, keys in columns and 0/1 values"""
+    return pd.DataFrame(membership.toarray().astype(np.int64), index=np.arange(membership.shape[0]), columns=keys)
+
+
+def _overlapping_node_pairs(node_membership, node_interval_rank):
+    """Return the pairs of nodes sharing samples and their number of shared samples, from the product B.T @ B of the
+    sparse sample x node membership matrix B. Pairs are ordered by interval, neighbouring interval, then cluster,
+    as the interval pairs are visited when checking clusters for overlap"""
+
+    B = node_membership.astype(np.int64)
+
+    #shared sample counts between distinct nodes
+    shared = sp.triu(B.T @ B, k=1).tocoo()
+    a, b = shared.row, shared.col
+    order = np.lexsort((b, a, node_interval_rank[b], node_interval_rank[a]))
+    return np.column_stack((a[order], b[order])), shared.data[order]
 
 
 def _build_cluster_index_labels(samples_in_clusters):
@@ -126,15 +331,27 @@ class MapperGraph():
     """ The Mapper class builds a network graph from data. The workflow allows you to:
             1. Transform the dataset
             2. Construct a lens function to project the data to a lower dimension
-            4. Build a cover of the lens from overlapping intervals
+            4. Build a cover of the lens from overlapping intervals (hypercubes for a lens with several columns)
             3. Perform clustering within each interval
             5. Construct a graph from the clustering
             6. Visualise the graph using networkx
 
+    A k-dimensional lens is given as a samples x k array, with intervals and overlap as a single value
+    or a sequence of k values (one per dimension). Intervals are then keyed by their tuple of cell indices.
+
+    The intervals are clustered in parallel when n_jobs > 1 (a process pool per graph) or when an
+    executor is given, which can be shared between graphs. A ClusteringCache shared between graphs on the
+    same data skips refitting intervals that hold the same samples.
+
+    The built graph holds the samples of each node as sorted index arrays (node_samples) and as sparse
+    samples x nodes membership matrices (node_membership, interval_membership). The samples_in_nodes and
+    samples_in_intervals dataframes are dense views built on first access.
+
+    rebuild returns the graph for new intervals or overlap, clustering only the intervals whose samples changed.
             """
 
 
-    def __init__(self, data, lens_function, intervals, overlap, clustering_algorithm, text = True):
+    def __init__(self, data, lens_function, intervals, overlap, clustering_algorithm, text = True, n_jobs = 1, executor = None, cache = None):
 
         self.data = data
         self.lens_function = lens_function
@@ -142,6 +359,11 @@ class MapperGraph():
         self.overlap = overlap
         self.clustering_algorithm = clustering_algorithm
         self.text = text
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.cache = cache
+        self._lens_order = None
+        self._previous_clusters = None
 
         if self.text == True:
             print("Initializing Mapper class...")
@@ -151,16 +373,22 @@ class MapperGraph():
     def build_graph(self):
         """This involves two steps - build a cover on the lens function to divide it into overlapping intervals, then
         clustering in each interval on the original point cloud. The networkx graph is built by converting the clusters
-        to nodes and edges are formed when two clusters have overlapping samples.  """
+        to nodes and edges are formed when two clusters have overlapping samples, with the number of shared samples
+        as the overlap_count edge attribute.  """
 
 
         if self.text == True:
             print("Build cover...")
-        samples_in_intervals, interval_sets = _build_cover_on_lens_function(self.data, self.lens_function, self.intervals, self.overlap)
+        if self._lens_order is None and np.squeeze(self.lens_function).ndim == 1:
+            self._lens_order = np.argsort(np.ravel(self.lens_function), kind="stable")
+        samples_in_intervals, interval_sets = _build_cover_on_lens_function(self.data, self.lens_function, self.intervals, self.overlap,
+                                                                            order = self._lens_order)
 
         if self.text == True:
             print("Build clusters...")
-        samples_in_clusters = _cluster_data_in_intervals(self.data, self.intervals, self.clustering_algorithm, samples_in_intervals)
+        samples_in_clusters = _cluster_data_in_intervals(self.data, self.intervals, self.clustering_algorithm, samples_in_intervals,
+                                                         n_jobs = self.n_jobs, executor = self.executor, cache = self.cache,
+                                                         previous = self._previous_clusters)
 
         #networkx graph class
         G = nx.Graph()
@@ -191,35 +419,69 @@ class MapperGraph():
 
 
 
-        #to build an edge check for overlapping samples between neighbouring nodes
-        #define the key list to iterate through dict and check neighbouring intervals
-        keyList=sorted(samples_in_clusters.keys())
-        for i, l in enumerate(keyList[:-1]):
-            l_neighbour = keyList[i+1]
-            cluster_points = samples_in_clusters[l]
-            cluster_points_neighbour = samples_in_clusters[l_neighbour]
-
-            for cluster_label, main_cluster in enumerate(cluster_points):
-                for cluster_label_neighbour, neighbour_cluster in enumerate(cluster_points_neighbour):
-                    #if any points in the main cluster being check are in the neighbouring cluster
-                    if any(point in main_cluster for point in neighbour_cluster):
-                        G.add_edge(node_dict[(l,cluster_label)], node_dict[(l_neighbour,cluster_label_neighbour)])
-
-
-        #convert samples_in_node from dict with node in keys and samples in values,
-        #to df with nodes in columns and samples in rows and binary values indicating the presence of sample in node
-        #def convert_index_dict_to_matrix():
-        interval_clusters = _convert_sampleID_dict_to_matrix(self.data, samples_in_intervals)
-        node_clusters = _convert_sampleID_dict_to_matrix(self.data, samples_in_node)
-
-
+        #to build an edge find the nodes with overlapping samples. Clusters within an interval are disjoint,
+        #so nodes sharing samples lie in overlapping intervals (or hypercube cells).
+        #The edges record the number of samples shared as overlap_count
+        node_interval_rank = np.array([rank for rank, i in enumerate(samples_in_clusters) for j in samples_in_clusters[i]], dtype=int)
+        node_membership = _sample_membership_matrix(len(self.data), samples_in_node)
+        node_pairs, overlap_counts = _overlapping_node_pairs(node_membership, node_interval_rank)
+        G.add_edges_from((int(u), int(v), {"overlap_count": int(c)}) for (u, v), c in zip(node_pairs, overlap_counts))
 
 
+        #sparse matrices with samples in rows and nodes (or intervals) in columns, indicating the presence of sample in node.
+        #The dense dataframes of samples_in_nodes and samples_in_intervals are only built when accessed
         self.graph = G
-        self.samples_in_nodes = node_clusters
+        self.node_samples = samples_in_node
+        self.node_membership = node_membership
         self.node_count_in_intervals = node_count_in_intervals
         self.nodes_in_intervals = nodes_in_intervals
-        self.samples_in_intervals = interval_clusters
+        self.interval_keys = list(samples_in_intervals)
+        self.interval_membership = _sample_membership_matrix(len(self.data), samples_in_intervals)
         self.interval_sets = interval_sets
+        self._samples_in_nodes = None
+        self._samples_in_intervals = None
+
+        #clusters of each interval keyed by its samples, reused by rebuild
+        content_keys = {i: _interval_content_key(np.sort(samples_in_intervals[i])) for i in samples_in_clusters}
+        self._interval_clusters = {content_keys[i]: samples_in_clusters[i] for i in samples_in_clusters}
+        previous_clusters = self._previous_clusters or {}
+        self.reclustered_intervals = [i for i in samples_in_clusters if previous_clusters.get(content_keys[i]) is not samples_in_clusters[i]]
 
         return G
+
+
+    def rebuild(self, intervals = None, overlap = None):
+        """Return a new MapperGraph of the same data, lens and clustering algorithm with new intervals and/or overlap.
+        The sort order of the lens is reused, and intervals holding the same samples as an interval of this graph keep
+        its clusters without clustering again, sharing the sample arrays of the unchanged nodes. Only the remaining
+        intervals, listed in reclustered_intervals of the new graph, are clustered. The graph must have been built"""
+
+        mapper = MapperGraph(data = self.data,
+                             lens_function = self.lens_function,
+                             intervals = self.intervals if intervals is None else intervals,
+                             overlap = self.overlap if overlap is None else overlap,
+                             clustering_algorithm = self.clustering_algorithm,
+                             text = self.text,
+                             n_jobs = self.n_jobs,
+                             executor = self.executor,
+                             cache = self.cache)
+        mapper._lens_order = self._lens_order
+        mapper._previous_clusters = self._interval_clusters
+        mapper.build_graph()
+        return mapper
+
+
+    @property
+    def samples_in_nodes(self):
+        """Dataframe with samples in rows and nodes in columns, with 1 where the sample is in the node"""
+        if self._samples_in_nodes is None:
+            self._samples_in_nodes = _membership_dataframe(self.node_membership, list(self.node_samples))
+        return self._samples_in_nodes
+
+
+    @property
+    def samples_in_intervals(self):
+        """Dataframe with samples in rows and intervals in columns, with 1 where the sample is in the interval"""
+        if self._samples_in_intervals is None:
+            self._samples_in_intervals = _membership_dataframe(self.interval_membership, self.interval_keys)
+        return self._samples_in_intervals
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+
+A module to prepare gene expression datasets for DSGA.
+
+Tumour cohorts are matched to the genes of a normal tissue reference dataset, and missing values are imputed from nearest neighbours.
+
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+import hot_mapper.data_cache as data_cache
+
+
+
+
+def match_genes(tumour_datasets, normal_dataset, output_path = None, file_format = "npy"):
+    """Restrict each tumour cohort and the normal dataset to their common genes.
+
+    The datasets have genes as rows and samples as columns. The normal gene index is hashed once and each
+    cohort is matched against it, keeping the gene order of the normal dataset. Only the matched genes are transposed.
+
+    Parameters
+    ----------
+
+    tumour_datasets : dictionary
+        Tumour dataframes keyed by dataset name
+
+    normal_dataset : pandas dataframe
+        Normal tissue reference dataset
+
+    output_path : str, default: ``None``
+        Directory to save {dataset_name}_tumour_matched and {dataset_name}_normal_matched to, with samples as rows
+
+    file_format : ["npy"],["parquet"],["csv"], default: ``"npy"``
+        File format of the saved matrices, see data_cache.save_matrix
+
+    Returns
+    -------
+
+    matched : dictionary
+        (tumour_matched, normal_matched) dataframes keyed by dataset name, with samples as rows and genes as columns
+
+    report : pandas dataframe
+        Number of tumour, normal, matched and unmatched genes for each dataset
+        """
+
+    normal_genes = normal_dataset.index
+
+    matched = {}
+    report = []
+    for dataset_name, tumour_dataset in tumour_datasets.items():
+        #hash based lookup of the normal genes in the tumour genes
+        in_tumour = normal_genes.isin(tumour_dataset.index)
+        matched_genes = normal_genes[in_tumour]
+
+        #subset original datasets, then transpose so samples are rows
+        tumour_matched = tumour_dataset.loc[matched_genes].T
+        normal_matched = normal_dataset[in_tumour].T
+        matched[dataset_name] = (tumour_matched, normal_matched)
+
+        report.append([tumour_dataset.shape[0],
+                       normal_dataset.shape[0],
+                       len(matched_genes),
+                       int(np.sum(~tumour_dataset.index.isin(normal_genes))),
+                       int(np.sum(~in_tumour))])
+
+        #save to file
+        if output_path is not None:
+            data_cache.save_matrix(tumour_matched, F"{output_path}/{dataset_name}_tumour_matched.{file_format}")
+            data_cache.save_matrix(normal_matched, F"{output_path}/{dataset_name}_normal_matched.{file_format}")
+
+    report = pd.DataFrame(report,
+                          index = list(tumour_datasets.keys()),
+                          columns = ["tumour_genes", "normal_genes", "matched_genes", "tumour_only_genes", "normal_only_genes"])
+
+    return matched, report
+
+
+
+def _nan_euclidean_terms(values, observed):
+    """Zero-filled values, squared row norms, squared values, missing and observed masks of the donor rows, computed
+    once for the NaN-aware euclidean distances of every chunk"""
+
+    zeros = np.where(observed, values, 0)
+    return (zeros,
+            np.einsum("ij,ij->i", zeros, zeros),
+            zeros * zeros,
+            (~observed).astype(float),
+            observed.astype(float))
+
+
+def _nan_euclidean_distances(receivers, receivers_observed, donor_terms):
+    """NaN-aware euclidean distances from receiver rows to the donor rows, as sklearn's nan_euclidean_distances, with
+    the donor terms of _nan_euclidean_terms. Only arrays of the size of the receivers x donors distances are allocated"""
+
+    zeros, norms, squares, missing, observed = donor_terms
+    receivers = np.where(receivers_observed, receivers, 0)
+
+    distances = -2 * (receivers @ zeros.T)
+    distances += np.einsum("ij,ij->i", receivers, receivers)[:,None]
+    distances += norms[None,:]
+    np.maximum(distances, 0, out=distances)
+
+    #remove the terms of the columns missing in either row
+    distances -= (receivers * receivers) @ missing.T
+    distances -= (~receivers_observed).astype(float) @ squares.T
+    np.clip(distances, 0, None, out=distances)
+
+    #scale by the fraction of the columns observed in both rows
+    present_count = receivers_observed.astype(float) @ observed.T
+    distances[present_count == 0] = np.nan
+    np.maximum(1, present_count, out=present_count)
+    distances /= present_count
+    distances *= receivers.shape[1]
+    return np.sqrt(distances, out=distances)
+
+
+def _masked_impute(values, missing, missing_rows, n_neighbors, max_memory):
+    """Impute each missing value as the mean of the nearest rows that observe its column, by the NaN-aware euclidean
+    distance of KNNImputer. Rows with no finite distance to any donor take the column mean, and columns without
+    observed values are left missing"""
+
+    observed = ~missing
+    with np.errstate(invalid="ignore", divide="ignore"):
+        column_mean = np.nansum(values, axis=0) / observed.sum(axis=0)
+    donor_terms = _nan_euclidean_terms(values, observed)
+
+    #rows per chunk so the receiver rows, their distances to all rows and the temporaries of the distances fit within max_memory
+    chunk_size = max(1, int(max_memory // (8 * (4 * values.shape[1] + 5 * values.shape[0]))))
+
+    imputed = values.copy()
+    for start in range(0, len(missing_rows), chunk_size):
+        rows = missing_rows[start:start+chunk_size]
+        distances = _nan_euclidean_distances(values[rows], observed[rows], donor_terms)
+
+        for column in np.flatnonzero(missing[rows].any(axis=0)):
+            donors = np.flatnonzero(observed[:,column])
+            if len(donors) == 0:
+                continue
+            receivers = np.flatnonzero(missing[rows, column])
+            receiver_distances = distances[np.ix_(receivers, donors)]
+
+            defined = ~np.isnan(receiver_distances).all(axis=1)
+            imputed[rows[receivers[~defined]], column] = column_mean[column]
+            if not np.any(defined):
+                continue
+
+            #average the nearest donors, ignoring donors without a finite distance
+            receiver_distances = receiver_distances[defined]
+            k = min(n_neighbors, len(donors))
+            nearest = np.argpartition(receiver_distances, k - 1, axis=1)[:,:k]
+            weights = (~np.isnan(np.take_along_axis(receiver_distances, nearest, axis=1))).astype(float)
+            imputed[rows[receivers[defined]], column] = np.average(values[donors[nearest], column], axis=1, weights=weights)
+
+    return imputed
+
+
+def _neighbour_index_impute(values, missing, missing_rows, n_neighbors, algorithm, max_memory):
+    """Impute the missing values of each row as the mean of its nearest complete rows, found by a sklearn
+    NearestNeighbors index over the columns without missing values"""
+
+    donor_rows = np.flatnonzero(~missing.any(axis=1))
+    complete_columns = np.flatnonzero(~missing.any(axis=0))
+
+    if len(donor_rows) == 0:
+        raise ValueError(F"algorithm {algorithm} needs at least one row without missing values")
+    if len(complete_columns) == 0:
+        raise ValueError(F"algorithm {algorithm} needs at least one column without missing values")
+
+    n_neighbors = min(n_neighbors, len(donor_rows))
+    donors = values[donor_rows]
+    index = NearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm).fit(donors[:,complete_columns])
+
+    #rows per chunk so the neighbour values fit within max_memory
+    chunk_size = max(1, int(max_memory // (8 * (n_neighbors + 2) * values.shape[1])))
+
+    imputed = values.copy()
+    for start in range(0, len(missing_rows), chunk_size):
+        rows = missing_rows[start:start+chunk_size]
+        neighbours = index.kneighbors(values[np.ix_(rows, complete_columns)], return_distance=False)
+
+        #average the neighbouring donors, and fill only the missing entries
+        neighbour_mean = donors[neighbours].mean(axis=1)
+        chunk = imputed[rows]
+        chunk[missing[rows]] = neighbour_mean[missing[rows]]
+        imputed[rows] = chunk
+
+    return imputed
+
+
+def knn_impute(data, n_neighbors = 10, algorithm = "masked", max_memory = 2**28):
+    """Impute missing values as the mean of the nearest neighbouring rows, in the same orientation as sklearn's KNNImputer.
+
+    Only the rows with missing values are imputed, processed in chunks so that the distances held at once fit within
+    max_memory. With algorithm = "masked" the result is that of KNNImputer(n_neighbors = n_neighbors), except that
+    columns without any observed value are kept, as missing.
+
+    Parameters
+    ----------
+
+    data : pandas dataframe
+        Dataset with missing values as NaN
+
+    n_neighbors : int, default: ``10``
+        Number of neighbouring rows averaged for each missing value
+
+    algorithm : ["masked"],["ball_tree"],["kd_tree"],["brute"], default: ``"masked"``
+        "masked" imputes each missing value from the nearest rows that observe its column, including partially observed
+        rows, with the NaN-aware euclidean distance over the columns observed in both rows. The other options are a
+        faster approximation that uses only the rows without missing values as donors, found by a sklearn
+        NearestNeighbors index over the columns without missing values
+
+    max_memory : int, default: ``2**28``
+        Upper bound in bytes on the distances and neighbour values held for one chunk of rows. The "masked" algorithm
+        also holds, for all chunks, four arrays of the size of the data
+        """
+
+    values = data.to_numpy(dtype=float)
+    missing = np.isnan(values)
+    missing_rows = np.flatnonzero(missing.any(axis=1))
+
+    if len(missing_rows) == 0:
+        return data.copy()
+
+    if algorithm == "masked":
+        imputed = _masked_impute(values, missing, missing_rows, n_neighbors, max_memory)
+    else:
+        imputed = _neighbour_index_impute(values, missing, missing_rows, n_neighbors, algorithm, max_memory)
+
+    return pd.DataFrame(imputed, index=data.index, columns=data.columns)
@@ -1,42 +1,171 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+
 import numpy as np
 
 
-def Lens(data, nonzero_features = None, weights = None, feature_list = None, weight_range = [-1,1]):
-    """Return a linear combination of a subset of features for each vector"""
+def _new_seed():
+    """Draw a fresh seed, so that every randomly generated lens can be regenerated"""
+    return int(np.random.default_rng().integers(2**32))
+
+
+def _lens_parameters(total_features, nonzero_features, seed, weight_range = [-1,1]):
+    """Regenerate the feature list and weights of a lens from its seed with a single generator"""
+
+    rng = np.random.default_rng(seed)
+
+    #create an index for the subset of features sampled in the lens function
+    feature_list = rng.choice(total_features, nonzero_features, replace=False)
+
+    #create a list of corresponding weights for each feature
+    weights = rng.uniform(low=weight_range[0], high=weight_range[1], size=nonzero_features)
+
+    return feature_list, weights
+
+
+def _lens_vector(data, feature_list, weights):
+    """Lens of every sample as the sum of the selected features x weights. Every lens is computed with this
+    product, so a lens regenerated from its id or saved weights is identical to the lens searched"""
+    return data[:,np.asarray(feature_list, dtype=int)] @ np.asarray(weights, dtype=float)
+
+
+def lens_id(seed, nonzero_features, weight_range = [-1,1]):
+    """Return the string identifying a lens by its (seed, nonzero_features, weight_range) key"""
+    return F"{int(seed)}:{int(nonzero_features)}:{float(weight_range[0])!r}:{float(weight_range[1])!r}"
+
+
+def parse_lens_id(lens_id):
+    """Return the (seed, nonzero_features, weight_range) key of a lens id"""
+    seed, nonzero_features, low, high = lens_id.split(":")
+    return int(seed), int(nonzero_features), [float(low), float(high)]
+
+
+def lens_from_id(data, lens_id):
+    """Regenerate the lens settings of a lens id on a dataset"""
+    seed, nonzero_features, weight_range = parse_lens_id(lens_id)
+    return Lens(data, nonzero_features = nonzero_features, weight_range = weight_range, seed = seed)
+
+
+def Lens(data, nonzero_features = None, weights = None, feature_list = None, weight_range = [-1,1], seed = None):
+    """Return a linear combination of a subset of features for each vector.
+    A random lens is drawn from seed, or from a fresh seed returned in the lens settings. The seed and lens id
+    are only returned for a drawn lens, not for given weights and feature_list"""
     
     #define the number of features samples used in the data
     #do not perform feature selection unless specified
     total_samples, total_features = data.shape
 
     #randomly select the subset of features and their corresponding weights
-    if weights is None and feature_list is None:
-
-        #create an index for the subset of features sampled in the lens function
-        rng = np.random.default_rng()
-        feature_list = rng.choice(total_features, nonzero_features, replace=False)
-        
-        #create a list of corresponding weights for each feature
-        weights = np.random.uniform(low=weight_range[0], high=weight_range[1], size=len(feature_list))
+    drawn = weights is None and feature_list is None
+    if drawn:
+        if seed is None:
+            seed = _new_seed()
+        feature_list, weights = _lens_parameters(total_features, nonzero_features, seed, weight_range)
     
     if nonzero_features is None:
-        nonzero_features = total_features
+        nonzero_features = len(feature_list)
         
     
     #for each sample in the dataset calculate the lens function 
-    lens = np.zeros(total_samples)
-    
-    #for each vector in the dataset
-    for v in range(total_samples):
-        x = data[v,:]
-    
-        for k in range(nonzero_features):
-            feature_i = feature_list[k]
-            #find the sum of all features x random
-            lens[v] += x[feature_i] * weights[k]
+    #as the sum of the selected features x random weights
+    lens = _lens_vector(data, np.asarray(feature_list, dtype=int)[:nonzero_features], np.asarray(weights, dtype=float)[:nonzero_features])
             
     lens_settings = {"lens": lens,
                     "weights": weights,
                     "feature_list": feature_list}
+
+    if drawn:
+        lens_settings["seed"] = seed
+        lens_settings["lens_id"] = lens_id(seed, nonzero_features, weight_range)
     
-    return lens_settings
\ No newline at end of file
+    return lens_settings
+
+
+def Lenses(data, n_lenses, nonzero_features, weights = None, feature_list = None, weight_range = [-1,1], seeds = None):
+    """Return many random lenses at once, with the lens of each column computed as by Lens.
+    weights and feature_list are arrays of shape (n_lenses, nonzero_features), drawn from seeds if not given.
+    The seeds and lens ids are only returned for drawn lenses"""
+
+    total_samples, total_features = data.shape
+
+    #randomly select the subset of features and their corresponding weights for every lens
+    drawn = weights is None and feature_list is None
+    if drawn:
+        if seeds is None:
+            seeds = [_new_seed() for l in range(n_lenses)]
+        parameters = [_lens_parameters(total_features, nonzero_features, seed, weight_range) for seed in seeds]
+        feature_list = np.array([p[0] for p in parameters])
+        weights = np.array([p[1] for p in parameters])
+
+    feature_list = np.asarray(feature_list, dtype=int)
+    weights = np.asarray(weights, dtype=float)
+
+    #column l of lens holds lens l for every sample. A single product with a features x lenses weight matrix
+    #rounds differently from Lens, which moves samples at the interval edges of the cover
+    lens = np.empty((total_samples, n_lenses))
+    for l in range(n_lenses):
+        lens[:,l] = _lens_vector(data, feature_list[l], weights[l])
+
+    lens_settings = {"lens": lens,
+                    "weights": weights,
+                    "feature_list": feature_list}
+
+    if drawn:
+        lens_settings["seeds"] = list(seeds)
+        lens_settings["lens_ids"] = [lens_id(seed, nonzero_features, weight_range) for seed in seeds]
+
+    return lens_settings
+
+
+
+class LensRegistry():
+    """ The LensRegistry class regenerates the random lenses of a dataset from their lens ids,
+    keeping the most recently used lens vectors in memory. Workers holding the same data can rebuild
+    any lens from its id without reading weights from file.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        Dataset the lenses are computed on
+
+    max_cached : int, default: ``128``
+        Number of lenses kept in memory
+            """
+
+    def __init__(self, data, max_cached = 128):
+        self.data = data
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+
+
+    def new_ids(self, n_lenses, nonzero_features, weight_range = [-1,1], seed = None):
+        """Return the ids of n_lenses new random lenses, all derived from seed when given"""
+
+        seeds = np.random.default_rng(seed).integers(2**32, size=n_lenses)
+        return [lens_id(int(s), nonzero_features, weight_range) for s in seeds]
+
+
+    def _store(self, key, lens_settings):
+        self._cache[key] = lens_settings
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+
+    def lens(self, key):
+        """Return the lens settings of a lens id, regenerating the lens if it is not cached"""
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        lens_settings = lens_from_id(self.data, key)
+        self._store(key, lens_settings)
+        return lens_settings
+
+
+    def lenses(self, keys):
+        """Return the lens settings of many lens ids, each regenerated as by lens if it is not cached"""
+
+        return [self.lens(k) for k in keys]
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+
+A module to compare the survival of hotspots with the rest of a cohort.
+
+The log-rank test of many hotspots against their neighbourhood (all other samples) is computed at once. The event times
+and the number of samples at risk are found once per cohort, and each hotspot is given as a column of a sample
+membership matrix.
+
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
+from functools import partial
+
+import hot_mapper.utils as utils
+
+
+
+
+def hotspot_membership(hotspot_samples, n_samples):
+    """Sparse boolean matrix with samples in rows and one column per hotspot, from a list of the sample indices of each hotspot"""
+
+    columns = np.repeat(np.arange(len(hotspot_samples)), [len(s) for s in hotspot_samples])
+    rows = np.concatenate([np.asarray(s, dtype=np.int64) for s in hotspot_samples]) if len(hotspot_samples) else np.empty(0, dtype=np.int64)
+    membership = sp.csc_matrix((np.ones(len(rows), dtype=bool), (rows, columns)), shape=(n_samples, len(hotspot_samples)))
+    membership.sum_duplicates()
+    return membership
+
+
+
+class LogRankScorer():
+    """ The LogRankScorer class performs the two group log-rank test between hotspots and the remaining
+    samples of a cohort, as lifelines.statistics.logrank_test, for many hotspots at once.
+
+    Parameters
+    ----------
+
+    durations : array
+        Survival time of each sample
+
+    event_observed : array, default: ``None``
+        1 if the event was observed for the sample, 0 if censored. All events are observed when None
+
+    Attributes
+    ----------
+
+    event_times : array
+        Distinct times of the observed events, in ascending order
+            """
+
+    def __init__(self, durations, event_observed = None):
+        durations = np.asarray(durations, dtype=float)
+        if event_observed is None:
+            event_observed = np.ones(len(durations))
+        event_observed = np.asarray(event_observed, dtype=float) > 0
+
+        self.n_samples = len(durations)
+        self.event_times = np.unique(durations[event_observed])
+        n_times = len(self.event_times)
+
+        #samples are at risk at the event times before the first event time after their own time
+        at_risk_until = np.searchsorted(self.event_times, durations, side="right")
+        self._risk_index = sp.csr_matrix((np.ones(self.n_samples), (at_risk_until, np.arange(self.n_samples))),
+                                         shape=(n_times + 1, self.n_samples))
+
+        #samples with an observed event, at the index of their event time
+        events = np.flatnonzero(event_observed)
+        self._event_index = sp.csr_matrix((np.ones(len(events)), (at_risk_until[events] - 1, events)),
+                                          shape=(n_times, self.n_samples))
+
+        #deaths and samples at risk in the whole cohort at each event time
+        self.deaths = np.asarray(self._event_index.sum(axis=1)).ravel()
+        self.at_risk = _reverse_cumsum(np.asarray(self._risk_index.sum(axis=1)).ravel())[1:]
+
+
+    def score(self, hotspots, max_memory = 2**28):
+        """Log-rank test of each hotspot against the remaining samples
+
+        Parameters
+        ----------
+
+        hotspots : array, scipy sparse matrix or list
+            Boolean samples x hotspots membership matrix, or a list of the sample indices of each hotspot
+
+        max_memory : int, default: ``2**28``
+            Upper bound in bytes on the per event time counts held for one chunk of hotspots
+
+        Returns
+        -------
+
+        results : pandas dataframe
+            For each hotspot its size, the observed and expected number of events in the hotspot, the
+            chi-squared test_statistic and p_value
+            """
+
+        if isinstance(hotspots, list):
+            hotspots = hotspot_membership(hotspots, self.n_samples)
+        hotspots = sp.csc_matrix(hotspots, dtype=float)
+        n_hotspots = hotspots.shape[1]
+
+        #hotspots per chunk so the counts at each event time fit within max_memory
+        chunk_size = max(1, int(max_memory // (8 * 6 * (len(self.event_times) + 1))))
+
+        results = np.empty((n_hotspots, 5))
+        for start in range(0, n_hotspots, chunk_size):
+            chunk = hotspots[:,start:start+chunk_size]
+
+            #deaths and samples at risk in each hotspot at each event time
+            deaths = np.asarray((self._event_index @ chunk).todense())
+            at_risk = _reverse_cumsum(np.asarray((self._risk_index @ chunk).todense()))[1:]
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                fraction = at_risk / self.at_risk[:,None]
+                observed = deaths.sum(axis=0)
+                expected = (self.deaths[:,None] * fraction).sum(axis=0)
+                variance = (self.deaths[:,None] * fraction * (1 - fraction)
+                            * ((self.at_risk - self.deaths) / np.maximum(self.at_risk - 1, 1))[:,None]).sum(axis=0)
+                statistic = np.where(variance > 0, np.square(observed - expected) / variance, np.nan)
+
+            results[start:start+chunk_size] = np.column_stack((np.asarray(chunk.sum(axis=0)).ravel(), observed, expected,
+                                                              statistic, stats.chi2.sf(statistic, 1)))
+
+        return pd.DataFrame(results, columns = ["size", "observed", "expected", "test_statistic", "p_value"])
+
+
+    def permutation_test(self, hotspots, n_permutations = 1000, batch_size = 100, n_jobs = 1, random_state = None):
+        """Permutation test of the log-rank statistics of a family of hotspots, shuffling the survival times and
+        events together across the samples. The hotspot memberships are reused for every permutation, and each batch
+        of permutations is scored in one call to score, in a pool of n_jobs worker processes when n_jobs > 1, see
+        utils.permutation_batches.
+
+        The corrected p-value of a hotspot is the fraction of permutations in which the largest statistic of any
+        hotspot of the family reaches its statistic (single-step maxT), controlling the family-wise error over the
+        hotspots given. The test is conditional on these memberships, so it does not account for hotspots selected
+        with the same survival labels, e.g. by a search on an attribute function of survival; Search.permutation_test
+        repeats the search for each permutation for that case. The results do not depend on n_jobs.
+
+        Returns the score of each hotspot, with its permutation_p_value and corrected_p_value"""
+
+        if isinstance(hotspots, list):
+            hotspots = hotspot_membership(hotspots, self.n_samples)
+        hotspots = sp.csr_matrix(hotspots, dtype=float)
+        results = self.score(hotspots)
+        statistic = results["test_statistic"].to_numpy()
+
+        batches = utils.permutation_batches(partial(_permuted_statistics, self, hotspots, statistic), n_permutations,
+                                            batch_size = batch_size, n_jobs = n_jobs, random_state = random_state)
+
+        exceed = np.sum([b[0] for b in batches], axis=0)
+        null_max = np.concatenate([b[1] for b in batches])
+
+        results["permutation_p_value"] = np.where(np.isnan(statistic), np.nan, (1 + exceed) / (n_permutations + 1))
+        results["corrected_p_value"] = np.where(np.isnan(statistic), np.nan,
+                                                (1 + np.sum(null_max[:,None] >= statistic, axis=0)) / (n_permutations + 1))
+        return results
+
+
+    def acceptance(self, alpha = 0.01):
+        """Acceptance criterion for Search.iter_hotspots, accepting hotspots with a log-rank p-value below alpha"""
+
+        def accept(hotspot):
+            return self.score([hotspot["samples"]])["p_value"].iloc[0] < alpha
+        return accept
+
+
+
+def _permuted_statistics(scorer, hotspots, statistic, seed, n_permutations):
+    """Log-rank statistics of the hotspots for a batch of permutations of the survival labels. Permuting the labels
+    is scored as permuting the rows of the membership matrix. Returns the number of permutations reaching the
+    statistic of each hotspot, and the largest statistic of each permutation"""
+
+    rng = np.random.default_rng(seed)
+    permuted = sp.hstack([hotspots[rng.permutation(scorer.n_samples)] for b in range(n_permutations)], format="csc")
+    null = scorer.score(permuted)["test_statistic"].to_numpy().reshape(n_permutations, hotspots.shape[1])
+    null = np.nan_to_num(null, nan=-np.inf)
+
+    return np.sum(null >= statistic, axis=0), np.max(null, axis=1, initial=-np.inf)
+
+
+def _reverse_cumsum(counts):
+    """Cumulative sum from the last row to the first"""
+    return np.cumsum(counts[::-1], axis=0)[::-1]
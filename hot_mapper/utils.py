@@ -6,26 +6,114 @@ import numpy as np
 from statistics import mean
 from itertools import chain
 import pandas as pd
+import scipy.sparse as sp
 import matplotlib as mpl
+from concurrent.futures import ProcessPoolExecutor
+
+def node_membership_matrix(node_index):
+    """Sparse samples x nodes matrix of a node membership dataframe (1 where the sample is in the node),
+    or of a sparse membership matrix such as MapperGraph.node_membership"""
+    if sp.issparse(node_index):
+        return sp.csc_matrix(node_index, dtype=float)
+    return sp.csc_matrix(np.asarray(node_index) == 1, dtype=float)
+
 
 def sample_index_in_nodes(node_index_dataframe, node_list):
+    if sp.issparse(node_index_dataframe):
+        membership = sp.csc_matrix(node_index_dataframe)[:,list(node_list)]
+        return pd.Index(np.flatnonzero(membership.getnnz(axis=1)))
     return node_index_dataframe[node_index_dataframe[node_list].max(axis=1) == 1].index
 
+
+def count_samples_in_nodes(node_index, node_list):
+    """Number of distinct samples in the union of the nodes in node_list"""
+    membership = node_membership_matrix(node_index)[:,list(node_list)]
+    return int(np.count_nonzero(membership.getnnz(axis=1)))
+
+
+def aggregate_node_attributes(node_index, attribute, statistics = ["mean"]):
+    """Summarise sample attributes over the samples in each node, from one sparse matrix product with the membership matrix.
+
+    Parameters
+    ----------
+
+    node_index : pandas dataframe or scipy sparse matrix
+        Samples x nodes membership, as MapperGraph.samples_in_nodes or MapperGraph.node_membership
+
+    attribute : array or pandas dataframe
+        Value for each sample, or samples x attributes for several attributes (e.g. survival endpoints) at once
+
+    statistics : list, default: ``["mean"]``
+        Any of "count", "sum", "mean", "var" and "std". The variance is the population variance of the samples in the node
+
+    Returns
+    -------
+
+    node_values : pandas dataframe
+        Nodes in rows and the statistics in columns. For several attributes the columns are (attribute, statistic) pairs
+        """
+
+    membership = node_membership_matrix(node_index)
+    nodes = node_index.columns if isinstance(node_index, pd.DataFrame) else np.arange(membership.shape[1])
+
+    names = attribute.columns if isinstance(attribute, pd.DataFrame) else None
+    values = np.asarray(attribute, dtype=float)
+    single = values.ndim == 1
+    values = values.reshape(len(values), -1)
+
+    #centre the attributes before summing squares, to limit cancellation in the variance
+    shift = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) else np.zeros(values.shape[1])
+    centred = values - shift
+    sums = membership.T @ np.hstack([centred, np.square(centred)])
+    count = np.asarray(membership.sum(axis=0)).ravel()[:,None]
+    n_attributes = values.shape[1]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centred_mean = sums[:,:n_attributes] / count
+        var = np.maximum(sums[:,n_attributes:] / count - np.square(centred_mean), 0)
+        reductions = {"count": np.repeat(count, n_attributes, axis=1),
+                      "sum": sums[:,:n_attributes] + count * shift,
+                      "mean": centred_mean + shift,
+                      "var": var,
+                      "std": np.sqrt(var)}
+
+    if single:
+        return pd.DataFrame({stat: reductions[stat][:,0] for stat in statistics}, index=nodes)
+
+    names = range(n_attributes) if names is None else names
+    columns = pd.MultiIndex.from_product([names, statistics])
+    node_values = np.stack([reductions[stat] for stat in statistics], axis=2).reshape(len(nodes), -1)
+    return pd.DataFrame(node_values, index=nodes, columns=columns)
+
+
+def permutation_batches(batch_function, n_permutations, batch_size = 100, n_jobs = 1, random_state = None):
+    """Run batch_function(seed, size) on batches of at most batch_size of the n_permutations, each batch with an
+    independent random stream spawned from random_state, and return the batch results in order.
+
+    The batches run in a pool of n_jobs worker processes when n_jobs > 1 (all cores when n_jobs < 0), otherwise in
+    this process. The results do not depend on n_jobs"""
+
+    #independent random streams for each batch
+    sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+
+    if 0 <= n_jobs <= 1:
+        return list(map(batch_function, seeds, sizes))
+    with ProcessPoolExecutor(max_workers = None if n_jobs < 0 else n_jobs) as executor:
+        return list(executor.map(batch_function, seeds, sizes))
+
+
 def colour_nodes_by_attribute(node_index_dataframe, attribute, norm = False):
-    """for each node, create a list of the y values for each index"""
+    """for each node, the mean of the attribute values of the samples in the node"""
     if norm == True:
         #normalise y values to range
-        attribute = range01(np.array(attribute))
+        attribute = np.ravel(range01(np.array(attribute)))
 
 
     #the node values are averaged over all patients contained in each node
-    node_values = []
-    for node in node_index_dataframe:
-        index = list(node_index_dataframe[node].loc[node_index_dataframe[node] == 1].index)
-        node_y = [attribute[i] for i in index]
-        node_values.append(np.mean(node_y))
+    node_values = aggregate_node_attributes(node_index_dataframe, attribute, statistics = ["mean"])["mean"]
 
-    return node_values
+    return list(node_values.to_numpy())
 
 #
 
@@ -42,8 +42,9 @@ def draw_graph(mapper_graph, attribute_function, samples_in_nodes, hotspot_nodes
 
     #colour the nodes by the attribute of choice
     #if attribute function provided as values for each sample, average per node
+    membership = utils.node_membership_matrix(samples_in_nodes)
     if len(attribute_function) == samples_in_nodes.shape[0]:
-        attribute_by_node = utils.colour_nodes_by_attribute(samples_in_nodes, attribute_function)
+        attribute_by_node = utils.colour_nodes_by_attribute(membership, attribute_function)
 
     elif len(attribute_function) == samples_in_nodes.shape[1]: 
         attribute_by_node = attribute_function
@@ -55,7 +56,7 @@ def draw_graph(mapper_graph, attribute_function, samples_in_nodes, hotspot_nodes
     colouring = cmap(norm((attribute_by_node)))
 
     #specify the number of samples in each node according to size attribute
-    nsize = [np.sum(samples_in_nodes[node]) for node in samples_in_nodes]
+    nsize = np.asarray(membership.sum(axis=0)).ravel()
     nodes = nx.draw_networkx_nodes(graph,
                               pos= pos,
                               node_color=colouring,